@@ -5,9 +5,18 @@ from path import Path
 
 from cosmo_tester.framework.config import load_config
 from cosmo_tester.framework.logger import get_logger
+from cosmo_tester.framework.phase_timer import report_phase_timings
+from cosmo_tester.framework.reaper import finish_reaper, report_teardowns
+from cosmo_tester.framework.shared_infrastructure import (
+    close_shared_infrastructure,
+)
 from cosmo_tester.framework.test_hosts import Hosts
+from cosmo_tester.framework.vm_pool import close_vm_pool
 from cosmo_tester.test_suites.cluster.conftest import _get_hosts
 
+# Background teardowns submitted by xdist workers, reported by the controller
+_worker_teardowns = []
+
 
 @pytest.fixture(scope='module')
 def logger(request):
@@ -92,6 +101,32 @@ def pytest_runtest_makereport(item, call):
         # No need to handle failed, there's a builtin hook for that
 
 
+def pytest_sessionfinish(session, exitstatus):
+    # Pooled VMs and shared infrastructure outlive the test modules using
+    # them. The pool and any background teardowns go first, as their VMs may
+    # use the shared infrastructure.
+    close_vm_pool()
+    teardowns = finish_reaper()
+    close_shared_infrastructure(get_logger('shared_infrastructure'))
+    if hasattr(session.config, 'workerinput'):
+        session.config.workeroutput['teardowns'] = teardowns
+    else:
+        # Under xdist, only the controller reports, including every
+        # worker's teardowns and timings (their temporary directories are
+        # under its own)
+        report_teardowns(teardowns + _worker_teardowns, get_logger('reaper'))
+        report_phase_timings(
+            get_logger('phase_timings'),
+            search_dir=str(session.config._tmp_path_factory.getbasetemp()),
+        )
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    _worker_teardowns.extend(
+        getattr(node, 'workeroutput', {}).get('teardowns', []))
+
+
 @pytest.fixture(scope='module')
 def image_based_manager(
         request, ssh_key, module_tmpdir, test_config, logger):
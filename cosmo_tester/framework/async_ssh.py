@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+
+from cosmo_tester.framework import util
+
+
+class AsyncSSHError(Exception):
+    """The ssh client could not run a command on the remote host."""
+
+
+def run_sync(coro):
+    """Run a coroutine to completion from synchronous code."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class AsyncSSHTransport(object):
+    """Runs commands on a single host from asyncio, using the openssh client.
+
+    All commands share one multiplexed master connection, so many commands
+    can be in flight at once without a thread (or a handshake) for each.
+    Concurrency per host is bounded by max_sessions, which should stay below
+    the MaxSessions setting (default 10) of the remote sshd.
+    """
+
+    def __init__(self, host, user, key_filename, logger, max_sessions=8,
+                 connect_timeout=10):
+        self.host = host
+        self.user = user
+        self.key_filename = key_filename
+        self.max_sessions = max_sessions
+        self.connect_timeout = connect_timeout
+        self._logger = logger
+        self._control_dir = tempfile.mkdtemp(prefix='cosmo_ssh_')
+        self._semaphores = {}
+
+    def _ssh_args(self):
+        return [
+            'ssh',
+            '-i', self.key_filename,
+            '-o', 'BatchMode=yes',
+            '-o', 'StrictHostKeyChecking=no',
+            '-o', 'UserKnownHostsFile=/dev/null',
+            '-o', 'LogLevel=ERROR',
+            '-o', 'ConnectTimeout={}'.format(self.connect_timeout),
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={}'.format(
+                os.path.join(self._control_dir, '%C')),
+            '-o', 'ControlPersist=300',
+            '{}@{}'.format(self.user, self.host),
+        ]
+
+    def _get_semaphore(self):
+        # Semaphores are bound to the event loop they were first used in
+        loop = asyncio.get_event_loop()
+        if loop not in self._semaphores:
+            self._semaphores = {
+                old_loop: semaphore
+                for old_loop, semaphore in self._semaphores.items()
+                if not old_loop.is_closed()
+            }
+            self._semaphores[loop] = asyncio.Semaphore(self.max_sessions)
+        return self._semaphores[loop]
+
+    async def run(self, command, use_sudo=False, stdin=None):
+        """Run a command, returning (return_code, stdout, stderr) as bytes.
+        As with fabric, use_sudo prefixes the command with sudo.
+        Raises AsyncSSHError if ssh itself failed (exit status 255).
+        """
+        if use_sudo:
+            command = 'sudo -n {}'.format(command)
+        args = self._ssh_args() + ['--', command]
+        async with self._get_semaphore():
+            proc = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=(subprocess.DEVNULL if stdin is None
+                       else subprocess.PIPE),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            stdout, stderr = await proc.communicate(stdin)
+        if proc.returncode == 255:
+            raise AsyncSSHError(
+                'Failed to run command on {host}: {err}'.format(
+                    host=self.host,
+                    err=stderr.decode('utf-8', 'replace').strip(),
+                )
+            )
+        return proc.returncode, stdout, stderr
+
+    async def put(self, remote_path, content, owner=None, mode=None):
+        """Write bytes to a remote path, as root."""
+        tmp_path = '/tmp/{}_{}'.format(
+            hashlib.sha1(remote_path.encode('utf-8')).hexdigest(),
+            uuid.uuid4().hex[:8],
+        )
+        commands = [
+            'cat > {}'.format(tmp_path),
+            'sudo mkdir -p {}'.format(
+                shlex.quote(os.path.dirname(remote_path) or '.')),
+            'sudo mv {} {}'.format(tmp_path, shlex.quote(remote_path)),
+        ]
+        if owner:
+            commands.append('sudo chown {} {}'.format(
+                owner, shlex.quote(remote_path)))
+        if mode:
+            commands.append('sudo chmod {} {}'.format(
+                mode, shlex.quote(remote_path)))
+        return_code, _, stderr = await self.run(' && '.join(commands),
+                                                stdin=content)
+        if return_code != 0:
+            raise AsyncSSHError(
+                'Failed to write {path} on {host}: {err}'.format(
+                    path=remote_path,
+                    host=self.host,
+                    err=stderr.decode('utf-8', 'replace').strip(),
+                )
+            )
+
+    async def get(self, remote_path):
+        """Read a remote file as bytes, as root."""
+        return_code, stdout, stderr = await self.run(
+            'sudo cat {}'.format(shlex.quote(remote_path)))
+        if return_code != 0:
+            raise AsyncSSHError(
+                'Failed to read {path} on {host}: {err}'.format(
+                    path=remote_path,
+                    host=self.host,
+                    err=stderr.decode('utf-8', 'replace').strip(),
+                )
+            )
+        return stdout
+
+    def close(self):
+        subprocess.call(
+            self._ssh_args()[:-1] + ['-O', 'exit',
+                                     '{}@{}'.format(self.user, self.host)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        shutil.rmtree(self._control_dir, ignore_errors=True)
+        self._semaphores = {}
+
+
+async def gather_in_parallel(func, items, logger):
+    """Await func(item) for each item concurrently.
+    Like util.run_in_parallel, results are returned in the same order as the
+    items and failures are aggregated into a util.ParallelExecutionError.
+    """
+    items = list(items)
+    outcomes = []
+    for result in await asyncio.gather(*[func(item) for item in items],
+                                       return_exceptions=True):
+        if isinstance(result, Exception):
+            outcomes.append((None, result))
+        else:
+            outcomes.append((result, None))
+    return util.collect_parallel_results(items, outcomes, logger)
+
+
+def benchmark_transports(hosts, logger, command='true', commands_per_host=20):
+    """Compare running many short commands on each linux instance of hosts
+    using threads with fabric against the asyncio transport.
+    Returns the wall clock time taken by each, in seconds.
+    """
+    instances = [instance for instance in hosts.instances
+                 if not instance.windows]
+
+    def _run_all_fabric(instance):
+        for _ in range(commands_per_host):
+            instance.run_command(command, hide_stdout=True)
+
+    async def _run_all_asyncio():
+        await asyncio.gather(*[
+            instance.arun_command(command, hide_stdout=True)
+            for instance in instances
+            for _ in range(commands_per_host)
+        ])
+
+    # Make sure connections are established for both before timing
+    hosts.run_on_all(command, instances=instances, hide_stdout=True)
+    hosts.run_on_all(command, instances=instances, hide_stdout=True,
+                     use_asyncio=True)
+
+    start = time.time()
+    util.run_in_parallel(_run_all_fabric, instances, logger=logger)
+    fabric_duration = time.time() - start
+
+    start = time.time()
+    run_sync(_run_all_asyncio())
+    asyncio_duration = time.time() - start
+
+    logger.info(
+        'Ran %d commands on %d hosts: fabric (thread per host) took %.2fs, '
+        'asyncio took %.2fs',
+        commands_per_host * len(instances), len(instances),
+        fabric_duration, asyncio_duration,
+    )
+    return {'fabric': fabric_duration, 'asyncio': asyncio_duration}
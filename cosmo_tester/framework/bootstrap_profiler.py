@@ -0,0 +1,192 @@
+from collections import OrderedDict
+from datetime import datetime
+import json
+import os
+import re
+import threading
+import time
+
+INSTALL_LOG = '/tmp/bs_logs/3_install'
+PROFILE_FILE = 'bootstrap_profile.txt'
+SERVICES = (
+    'queue_service',
+    'database_service',
+    'manager_service',
+    'monitoring_service',
+)
+
+# e.g. "2021-03-01 10:00:00,123 [RABBITMQ] Installing RabbitMQ..."
+LOG_LINE_PATTERN = re.compile(
+    r'^\[?(?P<time>\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2})(?:[.,](?P<ms>\d+))?'
+    r'\]?[\s-]*\[(?P<component>[A-Za-z0-9_]+)\]\s*(?P<message>.*)$'
+)
+SERVICE_PATTERN = re.compile(r'\b({})\b'.format('|'.join(SERVICES)))
+
+_history_lock = threading.Lock()
+
+
+def _parse_time(match):
+    timestamp = datetime.strptime(
+        match.group('time').replace('T', ' '), '%Y-%m-%d %H:%M:%S')
+    seconds = time.mktime(timestamp.timetuple())
+    if match.group('ms'):
+        seconds += float('0.' + match.group('ms'))
+    return seconds
+
+
+def parse_install_log(content):
+    """Get the (timestamp, component, message) of each timestamped line of
+    a cfy_manager install log, in order.
+    """
+    entries = []
+    for line in content.splitlines():
+        match = LOG_LINE_PATTERN.match(line.strip())
+        if match:
+            entries.append((_parse_time(match), match.group('component'),
+                            match.group('message')))
+    return entries
+
+
+def _spans(steps, end):
+    """Turn (name, start) pairs into name: duration, each step ending where
+    the next begins.
+    """
+    durations = OrderedDict()
+    for index, (name, start) in enumerate(steps):
+        step_end = steps[index + 1][1] if index + 1 < len(steps) else end
+        durations[name] = durations.get(name, 0) + step_end - start
+    return durations
+
+
+def profile_install_log(content):
+    """Work out how long each service and each component of a cfy_manager
+    install took.
+    Services are timed from the first line naming them to the first line
+    naming the next, components from their first to their last line.
+    Returns (service durations, component durations), in install order.
+    """
+    entries = parse_install_log(content)
+    if not entries:
+        return OrderedDict(), OrderedDict()
+    end = entries[-1][0]
+
+    service_steps = []
+    component_times = OrderedDict()
+    for timestamp, component, message in entries:
+        # Lines naming several services (e.g. listing what will be
+        # installed) do not mark the start of any of them
+        named = set(SERVICE_PATTERN.findall(message))
+        if len(named) == 1:
+            service = named.pop()
+            if not service_steps or service_steps[-1][0] != service:
+                service_steps.append((service, timestamp))
+        first, _ = component_times.get(component, (timestamp, None))
+        component_times[component] = (first, timestamp)
+
+    components = OrderedDict(
+        (component, last - first)
+        for component, (first, last) in component_times.items()
+    )
+    return _spans(service_steps, end), components
+
+
+def _previous_durations(history_path, key, testing_version, image_type):
+    """Get the durations recorded for the latest other testing_version
+    bootstrapped from the same image, averaged per step.
+    Returns (version, step: mean duration), or (None, {}).
+    """
+    if not os.path.exists(history_path):
+        return None, {}
+    by_version = OrderedDict()
+    with open(history_path) as history_handle:
+        for line in history_handle:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if (record.get('image_type') != image_type
+                    or record.get('testing_version') == testing_version):
+                continue
+            # Later records move their version to the end
+            versions = by_version.pop(record['testing_version'], [])
+            versions.append(record.get(key, {}))
+            by_version[record['testing_version']] = versions
+    if not by_version:
+        return None, {}
+    version, records = by_version.popitem()
+    totals = OrderedDict()
+    for record in records:
+        for step, duration in record.items():
+            totals.setdefault(step, []).append(duration)
+    return version, {step: sum(durations) / len(durations)
+                     for step, durations in totals.items()}
+
+
+def _format_table(title, durations, previous_version, previous):
+    lines = [title,
+             '{:<30} {:>10} {:>14} {:>8}'.format(
+                 'step', 'duration', previous_version or 'previous',
+                 'change')]
+    for step, duration in durations.items():
+        if step in previous:
+            before = previous[step]
+            change = '{:+.0f}%'.format(
+                (duration - before) / before * 100) if before else '-'
+            before = '{:.1f}s'.format(before)
+        else:
+            before = change = '-'
+        lines.append('{:<30} {:>9.1f}s {:>14} {:>8}'.format(
+            step, duration, before, change))
+    return '\n'.join(lines)
+
+
+def record_bootstrap_profile(content, tmpdir, host, image_type,
+                             testing_version, history_path, logger):
+    """Write the service and component durations of a cfy_manager install
+    log to bootstrap_profile.txt in tmpdir, comparing them with the last
+    other testing_version in the history file (if one is configured), and
+    add them to the history.
+    """
+    services, components = profile_install_log(content)
+    if not services and not components:
+        logger.warning('No timestamped steps found in the install log of '
+                       '%s, not profiling its bootstrap.', host)
+        return
+
+    history_path = os.path.expanduser(history_path) if history_path else None
+    previous_version = None
+    previous_services = previous_components = {}
+    if history_path:
+        with _history_lock:
+            previous_version, previous_services = _previous_durations(
+                history_path, 'services', testing_version, image_type)
+            _, previous_components = _previous_durations(
+                history_path, 'components', testing_version, image_type)
+
+    profile = '\n\n'.join([
+        'Bootstrap of {host} ({image}, {version})'.format(
+            host=host, image=image_type, version=testing_version),
+        _format_table('Services:', services,
+                      previous_version, previous_services),
+        _format_table('Components:', components,
+                      previous_version, previous_components),
+    ])
+    with open(os.path.join(tmpdir, PROFILE_FILE), 'w') as profile_handle:
+        profile_handle.write(profile + '\n')
+    logger.info('%s', profile)
+
+    if history_path:
+        history_dir = os.path.dirname(history_path)
+        if history_dir and not os.path.isdir(history_dir):
+            os.makedirs(history_dir)
+        record = {
+            'time': time.time(),
+            'testing_version': testing_version,
+            'image_type': image_type,
+            'host': host,
+            'services': services,
+            'components': components,
+        }
+        with _history_lock:
+            with open(history_path, 'a') as history_handle:
+                history_handle.write(json.dumps(record) + '\n')
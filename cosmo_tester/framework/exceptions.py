@@ -18,3 +18,9 @@ class ProcessExecutionError(Exception):
     def __init__(self, message, return_code=None):
         self.return_code = return_code
         super(ProcessExecutionError, self).__init__(message)
+
+
+class RemoteCommandError(Exception):
+    def __init__(self, message, results=None):
+        self.results = results or []
+        super(RemoteCommandError, self).__init__(message)
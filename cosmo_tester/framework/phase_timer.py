@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import glob
+import json
+import math
+import os
+import threading
+import time
+
+RECORDS_FILE = 'phase_timings.jsonl'
+
+# Every records file written to in this session, for the session report
+_record_files = set()
+_record_files_lock = threading.Lock()
+
+
+class PhaseTimer(object):
+    """Records how long each phase of creating and destroying test hosts
+    takes, one JSON record per line in phase_timings.jsonl under tmpdir.
+    """
+
+    def __init__(self, tmpdir):
+        self.path = os.path.join(tmpdir, RECORDS_FILE)
+        self.test_identifier = None
+        self._lock = threading.Lock()
+        # Latest duration of each phase, keyed on instance index
+        self._instance_durations = {}
+
+    def record(self, phase, start, duration, outcome='success',
+               instance_index=None):
+        record = {
+            'test_identifier': self.test_identifier,
+            'phase': phase,
+            'instance_index': instance_index,
+            'start': start,
+            'duration': duration,
+            'outcome': outcome,
+        }
+        with self._lock:
+            with open(self.path, 'a') as records_handle:
+                records_handle.write(json.dumps(record) + '\n')
+            if instance_index is not None:
+                self._instance_durations.setdefault(
+                    instance_index, OrderedDict())[phase] = duration
+        with _record_files_lock:
+            _record_files.add(self.path)
+
+    def instance_durations(self, instance_index):
+        """Get the latest duration of each phase recorded for an instance,
+        in the order they were first recorded.
+        """
+        with self._lock:
+            return OrderedDict(
+                self._instance_durations.get(instance_index, {}))
+
+    @contextmanager
+    def phase(self, phase, instance_index=None):
+        start = time.time()
+        outcome = 'success'
+        try:
+            yield
+        except BaseException:
+            outcome = 'failure'
+            raise
+        finally:
+            self.record(phase, start, time.time() - start, outcome,
+                        instance_index)
+
+
+def _percentile(sorted_values, percent):
+    # Nearest rank, so that the result is always an actual measurement
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def find_phase_timings(search_dir=None):
+    """Get the records files written to by this process, and any found
+    under search_dir (e.g. those of xdist workers, whose temporary
+    directories are under the controller's).
+    """
+    with _record_files_lock:
+        paths = set(_record_files)
+    if search_dir:
+        paths.update(glob.glob(
+            os.path.join(search_dir, '**', RECORDS_FILE), recursive=True))
+    return sorted(paths)
+
+
+def summarise_phase_timings(paths=None):
+    """Get the count, p50, p95 and max duration of each phase across all
+    records written in this process (or in the given files), in the order
+    the phases were first seen.
+    """
+    if paths is None:
+        paths = find_phase_timings()
+
+    durations = OrderedDict()
+    for path in paths:
+        with open(path) as records_handle:
+            for line in records_handle:
+                record = json.loads(line)
+                durations.setdefault(record['phase'], []).append(
+                    record['duration'])
+
+    summary = OrderedDict()
+    for phase, phase_durations in durations.items():
+        phase_durations.sort()
+        summary[phase] = {
+            'count': len(phase_durations),
+            'p50': _percentile(phase_durations, 50),
+            'p95': _percentile(phase_durations, 95),
+            'max': phase_durations[-1],
+        }
+    return summary
+
+
+def report_phase_timings(logger, search_dir=None):
+    summary = summarise_phase_timings(find_phase_timings(search_dir))
+    if not summary:
+        return
+    lines = ['{:<30} {:>6} {:>9} {:>9} {:>9}'.format(
+        'phase', 'count', 'p50', 'p95', 'max')]
+    for phase, stats in summary.items():
+        lines.append('{:<30} {:>6} {:>8.1f}s {:>8.1f}s {:>8.1f}s'.format(
+            phase, stats['count'], stats['p50'], stats['p95'], stats['max'],
+        ))
+    logger.info('Test host phase timings for this run:\n%s',
+                '\n'.join(lines))
@@ -0,0 +1,256 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from cosmo_tester.framework.logger import get_logger
+from cosmo_tester.framework.teardown import (
+    create_infrastructure_manager_client,
+    teardown_tenant,
+)
+
+JOURNAL_SUFFIX = '.json'
+LOCK_FILE = 'reaper.lock'
+LOG_FILE = 'reaper.log'
+# How long a reaper waits for more work before exiting, in seconds
+IDLE_TIMEOUT = 60
+
+PENDING = 'pending'
+IN_PROGRESS = 'in_progress'
+FAILED = 'failed'
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def _write_entry(path, entry):
+    tmp_path = path + '.tmp'
+    # Entries include the infrastructure manager's credentials
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as entry_handle:
+        json.dump(entry, entry_handle)
+    os.rename(tmp_path, path)
+
+
+def _load_entries(journal_dir):
+    entries = []
+    for name in sorted(os.listdir(journal_dir)):
+        if not name.endswith(JOURNAL_SUFFIX):
+            continue
+        path = os.path.join(journal_dir, name)
+        try:
+            with open(path) as entry_handle:
+                entries.append((path, json.load(entry_handle)))
+        except (IOError, OSError, ValueError):
+            # Removed or being replaced
+            continue
+    return entries
+
+
+class Reaper(object):
+    """Hands test tenants over to a background reaper process.
+
+    Tenants are journalled in journal_dir, one file each, so that a reaper
+    which dies can be replaced by another which resumes its work. Only one
+    reaper runs against a journal directory at a time, exiting once it has
+    been idle for a while. The journal may be shared with other test
+    sessions, so each Reaper only waits for the tenants submitted to it.
+    """
+
+    def __init__(self, journal_dir, workers, logger):
+        self.journal_dir = os.path.expanduser(journal_dir)
+        self.workers = workers
+        self._logger = logger
+        self._process = None
+        self.tenants = []
+        if not os.path.isdir(self.journal_dir):
+            os.makedirs(self.journal_dir, 0o700)
+
+    def submit(self, infra_mgr_config, tenant, deployments):
+        """Journal a tenant to be torn down, and make sure a reaper is
+        running to do it.
+        """
+        _write_entry(
+            self._entry_path(tenant),
+            {
+                'tenant': tenant,
+                'deployments': list(deployments),
+                'infrastructure_manager': {
+                    key: infra_mgr_config[key]
+                    for key in ('address', 'admin_password', 'ca_cert')
+                },
+                'submitted': time.time(),
+                'state': PENDING,
+            },
+        )
+        self.tenants.append(tenant)
+        self._logger.info('Tenant %s will be torn down in the background.',
+                          tenant)
+        self._ensure_running()
+
+    def _ensure_running(self):
+        if self._process is not None and self._process.poll() is None:
+            return
+        with open(os.path.join(self.journal_dir, LOG_FILE), 'a') as log:
+            # In its own session, so that it is not interrupted along with
+            # the tests
+            self._process = subprocess.Popen(
+                [sys.executable, '-m', 'cosmo_tester.framework.reaper',
+                 self.journal_dir, '--workers', str(self.workers)],
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+
+    def _entry_path(self, tenant):
+        return os.path.join(self.journal_dir, tenant + JOURNAL_SUFFIX)
+
+    def finish(self, timeout=60 * 60, poll_interval=5):
+        """Wait for the teardowns submitted to this reaper to finish.
+        Returns what report_teardowns needs to report on them.
+        """
+        deadline = time.time() + timeout
+        paths = {self._entry_path(tenant) for tenant in self.tenants}
+        while True:
+            unfinished = [
+                entry for path, entry in _load_entries(self.journal_dir)
+                if path in paths and entry['state'] != FAILED
+            ]
+            if not unfinished or time.time() > deadline:
+                break
+            self._logger.info(
+                'Waiting for background teardown of: %s',
+                ', '.join(entry['tenant'] for entry in unfinished),
+            )
+            self._ensure_running()
+            time.sleep(poll_interval)
+        return {'journal_dir': self.journal_dir, 'tenants': self.tenants}
+
+
+def report_teardowns(submissions, logger):
+    """Report background teardowns which did not succeed, clearing those
+    that failed from the journal.
+    submissions are as returned by Reaper.finish, possibly from several
+    processes (e.g. xdist workers). Returns the failed entries.
+    """
+    failed = []
+    for submission in submissions:
+        journal_dir = submission['journal_dir']
+        paths = {os.path.join(journal_dir, tenant + JOURNAL_SUFFIX)
+                 for tenant in submission['tenants']}
+        for path, entry in _load_entries(journal_dir):
+            if path not in paths:
+                continue
+            if entry['state'] != FAILED:
+                logger.error(
+                    'Background teardown of %s did not finish in time. It '
+                    'will be resumed by the next test session.',
+                    entry['tenant'],
+                )
+                continue
+            logger.error(
+                'Background teardown of %s (deployments: %s) failed: %s\n'
+                'See %s for details. It can be retried with test-reaper.',
+                entry['tenant'], ', '.join(entry['deployments']),
+                entry.get('error'),
+                os.path.join(journal_dir, LOG_FILE),
+            )
+            failed.append(entry)
+            os.remove(path)
+    return failed
+
+
+def get_reaper(test_config, logger):
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = Reaper(test_config['teardown']['journal_dir'],
+                             test_config['teardown']['background_workers'],
+                             logger)
+        return _reaper
+
+
+def finish_reaper():
+    """Wait for background teardowns started in this process, if any.
+    Returns a list of what report_teardowns needs to report on them.
+    """
+    global _reaper
+    with _reaper_lock:
+        reaper = _reaper
+        _reaper = None
+    if reaper is None or not reaper.tenants:
+        return []
+    return [reaper.finish()]
+
+
+def _reap(path, entry, logger):
+    tenant = entry['tenant']
+    logger.info('Tearing down %s', tenant)
+    start = time.time()
+    try:
+        teardown_tenant(
+            create_infrastructure_manager_client(
+                entry['infrastructure_manager']),
+            tenant, logger,
+        )
+    except Exception as err:
+        logger.exception('Failed to tear down %s', tenant)
+        entry['state'] = FAILED
+        entry['error'] = str(err)
+        _write_entry(path, entry)
+    else:
+        logger.info('Tore down %s in %.1fs', tenant, time.time() - start)
+        os.remove(path)
+
+
+def run_reaper(journal_dir, workers, logger):
+    lock_handle = open(os.path.join(journal_dir, LOCK_FILE), 'w')
+    try:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        logger.info('Another reaper is already running.')
+        return
+
+    in_flight = {}
+    idle_since = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            for path, entry in _load_entries(journal_dir):
+                if entry['state'] == FAILED or path in in_flight:
+                    continue
+                if entry['state'] == IN_PROGRESS:
+                    # Only one reaper runs at a time, so this one died
+                    logger.info('Resuming teardown of %s', entry['tenant'])
+                entry['state'] = IN_PROGRESS
+                _write_entry(path, entry)
+                in_flight[path] = executor.submit(_reap, path, entry, logger)
+
+            for path in [path for path, future in in_flight.items()
+                         if future.done()]:
+                in_flight.pop(path)
+
+            if in_flight:
+                idle_since = time.time()
+            elif time.time() - idle_since > IDLE_TIMEOUT:
+                break
+            time.sleep(2)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Tear down journalled test tenants.',
+    )
+    parser.add_argument('journal_dir')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    run_reaper(args.journal_dir, args.workers, get_logger('reaper'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import base64
+import json
+import threading
+
+from cosmo_tester.framework import util
+
+HELPER_NAME = 'cosmo_remote_helper.py'
+# How much longer than a command's timeout to wait for the helper to answer
+RESPONSE_TIMEOUT_MARGIN = 30
+
+
+class RemoteHelperError(Exception):
+    """The remote helper could not service a request."""
+
+
+class RemoteHelperDied(RemoteHelperError):
+    """The remote helper process or its connection is gone."""
+
+
+class RemoteHelperLost(RemoteHelperDied):
+    """The remote helper went away (or stopped answering) after it was sent
+    a request, which may or may not have been carried out.
+    """
+
+
+class RemoteHelper(object):
+    """Client for the long lived helper process on a linux test VM.
+
+    The helper is started once over its own SSH channel and then serves
+    framed (one JSON document per line) requests, avoiding the channel and
+    shell start-up cost of each plain SSH command.
+    Requests are serialised, so one helper can be shared between threads.
+    Commands which run for longer than timeout seconds are killed, and a
+    helper which does not answer in time is treated as dead.
+    """
+
+    def __init__(self, ssh_pool, username, python_path, logger,
+                 timeout=1800):
+        self._ssh_pool = ssh_pool
+        self._username = username
+        self._python_path = python_path
+        self._logger = logger
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._conn = None
+        self._channel = None
+        self._stdin = None
+        self._stdout = None
+
+    @property
+    def alive(self):
+        return self._channel is not None and not self._channel.closed
+
+    def start(self, script):
+        """Upload the helper script and start it on a dedicated connection.
+        """
+        self._conn = self._ssh_pool.acquire()
+        try:
+            # The helper runs as root, so it is started from a private
+            # directory which is made root's before it is run
+            helper_dir = self._conn.run(
+                'mktemp -d /tmp/cosmo_remote_helper.XXXXXXXX', hide=True,
+            ).stdout.strip()
+            helper_path = '{}/{}'.format(helper_dir, HELPER_NAME)
+            self._conn.put(script, helper_path)
+            self._conn.run(
+                'sudo -n chown -R root:root {dir} && '
+                'sudo -n chmod -R go-rwx {dir}'.format(dir=helper_dir),
+                hide=True,
+            )
+            self._channel = self._conn.open_session()
+            self._channel.settimeout(self.timeout + RESPONSE_TIMEOUT_MARGIN)
+            self._channel.exec_command('sudo -n {python} -u {path} {user}'
+                                       .format(python=self._python_path,
+                                               path=helper_path,
+                                               user=self._username))
+            self._stdin = self._channel.makefile('wb')
+            self._stdout = self._channel.makefile('rb')
+            # Make sure the helper is actually serving before we rely on it
+            self._request({'op': 'stat', 'path': '/'})
+        except Exception as err:
+            self.close()
+            raise RemoteHelperDied(
+                'Could not start remote helper on {host}: {err}'.format(
+                    host=self._ssh_pool.host, err=err,
+                )
+            )
+        self._logger.info('Started remote helper on %s',
+                          self._ssh_pool.host)
+
+    def close(self):
+        if self._channel is not None:
+            try:
+                self._channel.close()
+            except Exception:
+                pass
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+        self._channel = None
+        self._stdin = None
+        self._stdout = None
+
+    def _request(self, request):
+        try:
+            self._stdin.write(json.dumps(request).encode('utf-8') + b'\n')
+            self._stdin.flush()
+        except Exception as err:
+            self.close()
+            raise RemoteHelperDied(str(err))
+        try:
+            line = self._stdout.readline()
+        except Exception as err:
+            self.close()
+            raise RemoteHelperLost(str(err))
+        if not line:
+            self.close()
+            raise RemoteHelperLost('Remote helper exited on {}'.format(
+                self._ssh_pool.host))
+
+        response = json.loads(line.decode('utf-8'))
+        if not response.pop('ok'):
+            raise RemoteHelperError(response['error'])
+        return response
+
+    def request(self, op, **kwargs):
+        kwargs['op'] = op
+        with self._lock:
+            if not self.alive:
+                raise RemoteHelperDied('Remote helper is not running on '
+                                       '{}'.format(self._ssh_pool.host))
+            return self._request(kwargs)
+
+    def exec_command(self, command, use_sudo=False):
+        """Run a command as fabric would (with sudo prefixed if use_sudo),
+        returning (rc, stdout, stderr).
+        """
+        response = self.request('exec', command=command, sudo=use_sudo,
+                                timeout=self.timeout)
+        return (
+            response['return_code'],
+            base64.b64decode(response['stdout']).decode('utf-8', 'replace'),
+            base64.b64decode(response['stderr']).decode('utf-8', 'replace'),
+        )
+
+    def read_file(self, path, offset=0, length=None):
+        response = self.request('read', path=path, offset=offset,
+                                length=length)
+        return base64.b64decode(response['data'])
+
+    def write_file(self, path, content, owner=None, mode=None):
+        self.request('write', path=path,
+                     data=base64.b64encode(content).decode('ascii'),
+                     owner=owner, mode=mode)
+
+    def stat(self, path):
+        return self.request('stat', path=path)
+
+    def hash_files(self, paths):
+        return self.request('hash', paths=paths)['digests']
+
+
+def get_helper_script_path():
+    return util.get_resource_path('scripts/remote_helper.py')
@@ -0,0 +1,123 @@
+from datetime import datetime
+import tempfile
+import threading
+
+from path import Path
+
+from cosmo_tester.framework import test_hosts, util
+
+_registry = {}
+_registry_lock = threading.Lock()
+# Held while deploying each key's infrastructure, so that only callers
+# wanting the same infrastructure wait for it
+_deploy_locks = {}
+
+
+class SharedInfrastructure(object):
+    """An infrastructure deployment (networks, security group, keypair) used
+    by the test VMs of every Hosts in the session with the same platform and
+    multi_net setting.
+
+    It lives in a tenant of its own on the infrastructure manager. Test VMs
+    only refer to its resources by name, so they can still be deployed in
+    each Hosts' own tenant.
+    """
+
+    def __init__(self, test_config, logger, multi_net):
+        self._logger = logger
+        self.refcount = 0
+        self.name = 'sharedinfra_{platform}{multi_net}_{time}'.format(
+            platform=test_config['target_platform'],
+            multi_net='_multinet' if multi_net else '',
+            time=datetime.strftime(datetime.now(), '%Y%m%d%H%M%S'),
+        )
+        tmpdir = Path(tempfile.mkdtemp(prefix='shared_infra_'))
+        # The infrastructure's keypair is made from this key, so test VMs
+        # have to be told about their own keys when they are deployed
+        self._hosts = test_hosts.Hosts(
+            util.GeneratedSSHKey(tmpdir, 'shared_infra_key'), tmpdir,
+            test_config, logger, request=None, instances=[],
+            multi_net=multi_net,
+        )
+        self._hosts.use_shared_infrastructure = False
+        # Test VMs might still be using it until this has finished
+        self._hosts.background_teardown = False
+
+    def deploy(self):
+        self._logger.info('Deploying shared test infrastructure %s',
+                          self.name)
+        try:
+            self._hosts._create_test_infrastructure(self.name)
+        except Exception as err:
+            self._logger.error(
+                'Encountered exception trying to create shared test '
+                'infrastructure: %s.\nAttempting to tear it down.', str(err)
+            )
+            self.destroy()
+            raise
+
+    @property
+    def network_mappings(self):
+        return getattr(self._hosts, 'network_mappings', {})
+
+    @property
+    def platform_resource_ids(self):
+        return self._hosts._platform_resource_ids
+
+    def destroy(self):
+        self._logger.info('Destroying shared test infrastructure %s',
+                          self.name)
+        self._hosts.destroy(passed=True)
+
+
+def acquire_shared_infrastructure(test_config, logger, multi_net=False):
+    """Get the shared infrastructure for this platform and multi_net setting,
+    deploying it if this is its first use in the session.
+    Every call must be matched by a release_shared_infrastructure call.
+    """
+    key = (test_config['target_platform'], bool(multi_net))
+    with _registry_lock:
+        deploy_lock = _deploy_locks.setdefault(key, threading.Lock())
+
+    with deploy_lock:
+        with _registry_lock:
+            infrastructure = _registry.get(key)
+            if infrastructure is not None:
+                infrastructure.refcount += 1
+                return infrastructure
+
+        infrastructure = SharedInfrastructure(test_config, logger,
+                                              multi_net)
+        infrastructure.deploy()
+        with _registry_lock:
+            _registry[key] = infrastructure
+            infrastructure.refcount += 1
+        return infrastructure
+
+
+def release_shared_infrastructure(infrastructure):
+    with _registry_lock:
+        infrastructure.refcount -= 1
+
+
+def close_shared_infrastructure(logger):
+    """Tear down all shared infrastructure at the end of the session."""
+    with _registry_lock:
+        infrastructures = list(_registry.values())
+        _registry.clear()
+
+    for infrastructure in infrastructures:
+        if infrastructure.refcount > 0:
+            logger.warning(
+                'Shared infrastructure %s is still used by %d test hosts '
+                'which were not torn down, so it will not be destroyed. '
+                'To tear down, clean deployments on your test manager under '
+                'tenant %s', infrastructure.name, infrastructure.refcount,
+                infrastructure.name,
+            )
+            continue
+        try:
+            infrastructure.destroy()
+        except Exception as err:
+            logger.error('Failed to destroy shared infrastructure %s: %s',
+                         infrastructure.name, err)
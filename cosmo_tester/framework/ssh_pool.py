@@ -0,0 +1,193 @@
+from contextlib import contextmanager
+import socket
+import threading
+
+from fabric import Connection
+from paramiko.ssh_exception import SSHException
+
+
+class PooledConnection(object):
+    """A fabric connection handed out by a pool.
+
+    The pool's health check cannot tell that a connection is half open
+    (e.g. because the host rebooted), so a reused connection is checked by
+    opening a channel on it before it is first used, and replaced with a new
+    connection if that fails. Operations are never retried once they have
+    started, as a command may already be running.
+    Other attributes are those of the fabric connection.
+    """
+
+    def __init__(self, pool, connection, reused):
+        self._pool = pool
+        self.connection = connection
+        self._reused = reused
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def _replace(self, err):
+        self._pool._logger.info(
+            'Pooled SSH connection to %s failed (%s), reconnecting.',
+            self._pool.host, err,
+        )
+        self._pool._discard(self.connection)
+        self.connection = self._pool._connect()
+
+    def _ensure_usable(self):
+        if not self._reused:
+            return
+        self._reused = False
+        try:
+            self.connection.transport.open_session(
+                timeout=self._pool.connect_timeout).close()
+        except (SSHException, socket.error, EOFError) as err:
+            self._replace(err)
+
+    def run(self, *args, **kwargs):
+        self._ensure_usable()
+        return self.connection.run(*args, **kwargs)
+
+    def sudo(self, *args, **kwargs):
+        self._ensure_usable()
+        return self.connection.sudo(*args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        self._ensure_usable()
+        return self.connection.put(*args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        self._ensure_usable()
+        return self.connection.get(*args, **kwargs)
+
+    def open_session(self, timeout=None):
+        """Open a new paramiko channel on the connection.
+        Nothing has been sent if this fails, so on a reused connection it is
+        retried once on a new connection.
+        """
+        reused, self._reused = self._reused, False
+        try:
+            return self.connection.transport.open_session(timeout=timeout)
+        except (SSHException, socket.error, EOFError) as err:
+            if not reused:
+                raise
+            self._replace(err)
+            return self.connection.transport.open_session(timeout=timeout)
+
+
+class SSHConnectionPool(object):
+    """Keeps idle fabric connections to a single host for reuse.
+
+    Connections are health checked before being handed out, so a pooled
+    connection that died (e.g. because the host rebooted) is usually
+    replaced with a new one before it is used. See PooledConnection for the
+    rest.
+    """
+
+    def __init__(self, host, user, key_filename, logger, connect_timeout=3):
+        self.host = host
+        self.user = user
+        self.key_filename = key_filename
+        self.connect_timeout = connect_timeout
+        self._logger = logger
+        self._idle = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'discarded': self.discarded,
+        }
+
+    def _connect(self):
+        conn = Connection(
+            host=self.host,
+            user=self.user,
+            connect_kwargs={
+                'key_filename': [self.key_filename],
+            },
+            port=22,
+            connect_timeout=self.connect_timeout,
+        )
+        try:
+            conn.open()
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn):
+        transport = conn.transport
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            # Cheap round trip-free write which fails on dead sockets
+            transport.send_ignore()
+        except (SSHException, socket.error, EOFError):
+            return False
+        return True
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                break
+            if self._is_healthy(conn):
+                with self._lock:
+                    self.hits += 1
+                return PooledConnection(self, conn, reused=True)
+            self._discard(conn)
+
+        conn = self._connect()
+        with self._lock:
+            self.misses += 1
+        return PooledConnection(self, conn, reused=False)
+
+    def release(self, conn):
+        with self._lock:
+            self._idle.append(conn.connection)
+
+    def _discard(self, conn):
+        with self._lock:
+            self.discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except (SSHException, socket.error, EOFError):
+            # The connection may be in an unknown state, don't reuse it
+            self._discard(conn.connection)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def log_stats(self):
+        self._logger.info(
+            'SSH connection pool for %s: %d hits, %d misses, %d discarded',
+            self.host, self.hits, self.misses, self.discarded,
+        )
@@ -0,0 +1,200 @@
+from contextlib import contextmanager
+from datetime import datetime
+import re
+import time
+
+from cosmo_tester.framework import util
+
+# Test tenants are named <test>_<YYYYmmddHHMMSS>
+TEST_TENANT_PATTERN = re.compile(r'^(?P<test>.+)_(?P<time>\d{14})$')
+# Tenants of the warm VM pool and shared infrastructure, which are used by
+# many tests and removed at the end of the session which created them
+SHARED_TENANT_PREFIXES = ('vmpool_', 'sharedinfra_')
+
+
+class TeardownError(RuntimeError):
+    """Test resources on the infrastructure manager could not be removed."""
+
+
+def create_infrastructure_manager_client(infra_mgr_config):
+    """Create a client for the infrastructure manager, given a mapping with
+    the address, admin_password and ca_cert of the infrastructure_manager
+    config.
+    """
+    return util.create_rest_client(
+        infra_mgr_config['address'],
+        username='admin',
+        password=infra_mgr_config['admin_password'],
+        cert=infra_mgr_config['ca_cert'],
+        protocol='https' if infra_mgr_config['ca_cert'] else 'http',
+    )
+
+
+def find_test_tenants(client, min_age=0, include_shared=False):
+    """List the tenants created for tests, oldest first.
+    The VM pool and shared infrastructure tenants are only included if
+    include_shared is set.
+    Returns (tenant name, age in seconds) tuples.
+    """
+    now = datetime.now()
+    tenants = []
+    for tenant in client.tenants.list(_include=['name']):
+        match = TEST_TENANT_PATTERN.match(tenant['name'])
+        if not match:
+            continue
+        if (not include_shared
+                and tenant['name'].startswith(SHARED_TENANT_PREFIXES)):
+            continue
+        created = datetime.strptime(match.group('time'), '%Y%m%d%H%M%S')
+        age = (now - created).total_seconds()
+        if age >= min_age:
+            tenants.append((tenant['name'], age))
+    return sorted(tenants, key=lambda tenant: -tenant[1])
+
+
+@contextmanager
+def _untimed(phase):
+    yield
+
+
+def teardown_tenant(client, tenant, logger, phase_timer=None):
+    """Stop all executions in a test tenant, uninstall and delete all of its
+    deployments (test VMs first, then the infrastructure), delete its plugins
+    and finally the tenant itself.
+    Blueprints are not deleted, as they are shared between tenants.
+    If a PhaseTimer is given, each of these steps is timed.
+    """
+    phase = phase_timer.phase if phase_timer else _untimed
+    with util.set_client_tenant(client, tenant):
+        with phase('teardown_stop_executions'):
+            _stop_executions(client, logger)
+
+        deployments = [
+            deployment['id']
+            for deployment in client.deployments.list(_include=['id'])
+        ]
+        with phase('teardown_uninstall_vms'):
+            _uninstall_deployments(
+                client,
+                [deployment for deployment in deployments
+                 if deployment != 'infrastructure'],
+                logger,
+            )
+
+        if 'infrastructure' in deployments:
+            with phase('teardown_uninstall_infrastructure'):
+                logger.info('Uninstalling infrastructure')
+                util.run_blocking_execution(client, 'infrastructure',
+                                            'uninstall', logger)
+                util.delete_deployment(client, 'infrastructure', logger)
+
+        with phase('teardown_delete_plugins'):
+            _delete_tenant_plugins(client, tenant, logger)
+
+    with phase('teardown_delete_tenant'):
+        logger.info('Deleting tenant %s', tenant)
+        with util.set_client_tenant(client, 'default_tenant'):
+            client.tenants.delete(tenant)
+
+
+def _stop_executions(client, logger):
+    logger.info('Ensuring executions are stopped.')
+    to_cancel = []
+    for execution in client.executions.list():
+        if execution['workflow_id'] != 'create_deployment_environment':
+            logger.info(
+                'Ensuring %s (%s) is not running.',
+                execution['id'],
+                execution['workflow_id'],
+            )
+            to_cancel.append(execution['id'])
+        else:
+            logger.info(
+                'Skipping %s (%s).',
+                execution['id'],
+                execution['workflow_id'],
+            )
+    util.run_in_parallel(
+        lambda execution_id: client.executions.cancel(
+            execution_id, force=True, kill=True),
+        to_cancel, max_workers=10, logger=logger,
+    )
+
+    cancel_failures = _wait_for_cancellations(client, to_cancel, logger)
+    if cancel_failures:
+        logger.error(
+            'Teardown failed due to the following executions not '
+            'entering the correct state after kill-cancel: {}'.format(
+                ', '.join(sorted(cancel_failures)),
+            )
+        )
+        raise TeardownError('Could not complete teardown.')
+
+
+def _wait_for_cancellations(client, execution_ids, logger, attempts=30,
+                            poll_interval=3):
+    """Wait for kill-cancelled executions to be cancelled, checking all of
+    them with a single list call each time.
+    Returns the IDs of any which were not cancelled in time.
+    """
+    pending = set(execution_ids)
+    for attempt in range(attempts):
+        if not pending:
+            break
+        if attempt:
+            time.sleep(poll_interval)
+        executions = client.executions.list(
+            id=list(pending),
+            include_system_workflows=True,
+            _include=['id', 'status'],
+            _size=len(pending),
+        )
+        for execution in executions:
+            logger.info('{} is in state {}.'.format(
+                execution['id'],
+                execution['status'],
+            ))
+            if execution['status'] == 'cancelled':
+                pending.discard(execution['id'])
+    return pending
+
+
+def _uninstall_deployments(client, deployment_ids, logger):
+    uninstalls = []
+    for deployment_id in deployment_ids:
+        logger.info('Uninstalling %s', deployment_id)
+        uninstalls.append(client.executions.start(deployment_id, 'uninstall'))
+
+    uninstalled = []
+    failure = None
+    try:
+        for execution in util.wait_for_executions(client, uninstalls,
+                                                  logger):
+            if execution.status == execution.TERMINATED:
+                uninstalled.append(execution.deployment_id)
+    except util.ExecutionsFailed as err:
+        # Deployments which did uninstall can go even if others failed
+        failure = err
+    util.delete_deployments(client, uninstalled, logger)
+    if failure:
+        raise failure
+
+
+def _delete_tenant_plugins(client, tenant, logger):
+    logger.info('Deleting plugins.')
+    to_delete = []
+    for plugin in client.plugins.list():
+        if plugin["tenant_name"] != tenant:
+            logger.info(
+                'Skipping shared %s (%s)',
+                plugin['package_name'],
+                plugin['id'],
+            )
+        else:
+            logger.info(
+                'Deleting %s (%s)',
+                plugin['package_name'],
+                plugin['id'],
+            )
+            to_delete.append(plugin['id'])
+    util.run_in_parallel(client.plugins.delete, to_delete, logger=logger)
@@ -1,34 +1,111 @@
+from collections import namedtuple
 from contextlib import contextmanager
+import asyncio
 import copy
 from datetime import datetime
 import functools
+import fnmatch
 import hashlib
+import io
 import json
 import os
 import random
 import re
+import shlex
 import string
 import socket
 import subprocess
+import sys
+import tarfile
+import threading
 import time
 import uuid
 import yaml
 
-from fabric import Connection
 from ipaddress import ip_address, ip_network
 from paramiko.ssh_exception import NoValidConnectionsError, SSHException
 import requests
 import retrying
 import textwrap
-import winrm
 
 from cloudify_rest_client.exceptions import CloudifyClientError
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Result
 
 from cosmo_tester.framework import util
+from cosmo_tester.framework.async_ssh import (
+    AsyncSSHTransport,
+    gather_in_parallel,
+    run_sync,
+)
+from cosmo_tester.framework.bootstrap_profiler import (
+    INSTALL_LOG as BOOTSTRAP_INSTALL_LOG,
+    record_bootstrap_profile,
+)
 from cosmo_tester.framework.constants import CLOUDIFY_TENANT_HEADER
+from cosmo_tester.framework.exceptions import RemoteCommandError
+from cosmo_tester.framework.phase_timer import PhaseTimer
+from cosmo_tester.framework.reaper import get_reaper
+from cosmo_tester.framework.remote_helper import (
+    get_helper_script_path,
+    RemoteHelper,
+    RemoteHelperDied,
+    RemoteHelperError,
+    RemoteHelperLost,
+)
+from cosmo_tester.framework.ssh_pool import SSHConnectionPool
+from cosmo_tester.framework.teardown import (
+    create_infrastructure_manager_client,
+    teardown_tenant,
+)
+from cosmo_tester.framework.winrm_session import WinRMShellSession
 
 HEALTHY_STATE = 'OK'
 
+BOOTSTRAP_STATUS_MARKER = '@@cosmo_tester_bootstrap:'
+# Follows the bootstrap logs until one of the completion markers appears,
+# with a periodic heartbeat so that a dead connection is noticed
+BOOTSTRAP_WATCH_SCRIPT = '''
+shopt -s nullglob
+logs=(/tmp/bs_logs/*)
+[[ -e /tmp/bs_logs/3_install ]] || logs+=(/tmp/bs_logs/3_install)
+tail -n5 -F "${{logs[@]}}" 2>/dev/null &
+tail_pid=$!
+checks=0
+until [[ -f /tmp/bootstrap_complete || -f /tmp/bootstrap_failed ]]; do
+    sleep 1
+    checks=$((checks + 1))
+    if (( checks % 20 == 0 )); then
+        date > /tmp/cfy_mgr_last_check_time
+        echo {marker}waiting
+    fi
+done
+# Let the last lines of the logs through before stopping
+sleep 1
+kill $tail_pid
+wait $tail_pid 2>/dev/null
+if [[ -f /tmp/bootstrap_complete ]]; then
+    echo {marker}done
+else
+    echo {marker}failed
+fi
+'''.format(marker=BOOTSTRAP_STATUS_MARKER)
+# How long to wait for any output from the bootstrap watcher, in seconds
+BOOTSTRAP_WATCH_TIMEOUT = 90
+# Remote log directories collected from VMs, with their local names
+LOG_DIRECTORIES = (
+    ('/tmp/bs_logs', 'bs_logs'),
+    ('/var/log/cloudify', 'cloudify'),
+)
+
+
+class CommandResult(namedtuple('CommandResult', [
+    'command', 'return_code', 'stdout', 'stderr', 'duration',
+])):
+    @property
+    def ok(self):
+        return self.return_code == 0
+
 
 def only_manager(func):
     @functools.wraps(func)
@@ -53,6 +130,14 @@ class VM(object):
         self._test_config = test_config
         self.windows = 'windows' in image_type
         self._tmpdir_base = None
+        self._ssh_pool = None
+        self.use_remote_helper = test_config['remote_helper']
+        self._remote_helper = None
+        # Only one thread may start this VM's helper
+        self._remote_helper_lock = threading.Lock()
+        self._remote_helper_failed = False
+        self._async_transport = None
+        self._winrm_session = None
         self.bootstrappable = bootstrappable
         self.image_type = image_type
         self.is_manager = self._is_manager_image_type()
@@ -84,6 +169,13 @@ class VM(object):
         self.deployment_id = deployment_id
         self.server_id = server_id
         self.server_index = server_index
+        self.close_ssh_connections()
+        self._ssh_pool = SSHConnectionPool(
+            host=self.ip_address,
+            user=self.username,
+            key_filename=self.private_key_path,
+            logger=self._logger,
+        )
         if self.is_manager:
             self.networks = networks
             self.basic_install_config = {
@@ -173,16 +265,37 @@ $user.SetInfo()""".format(fw_cmd=add_firewall_cmd,
             raise
         self._logger.info('...Windows VM is up.')
 
-    def get_windows_remote_file_content(self, path):
-        return self.run_command(
-            'Get-Content -Path {}'.format(path),
-            powershell=True).std_out
+    def _get_winrm_session(self):
+        if self._winrm_session is None:
+            self._winrm_session = WinRMShellSession(
+                self.ip_address, self.username, self.password, self._logger,
+            )
+        return self._winrm_session
 
-    @retrying.retry(stop_max_attempt_number=60, wait_fixed=3000)
-    def wait_for_ssh(self):
+    def get_windows_remote_file_content(self, path):
+        content = io.BytesIO()
+        self._get_windows_file(path, content)
+        return content.getvalue()
+
+    def wait_for_ssh(self, probe_port=True):
+        """Wait for SSH to be usable on this VM.
+        The SSH port is probed with plain TCP connects first so that we don't
+        pay for a full SSH handshake on every attempt while the VM boots.
+        """
         if self.enable_ssh_wait:
-            with self.ssh() as conn:
-                conn.run("echo SSH is up for {}".format(self.ip_address))
+            if probe_port:
+                util.wait_for_tcp_ports([(self.ip_address, 22)],
+                                        logger=self._logger)
+            self._check_ssh()
+
+    # sshd may accept connections before cloud-init has installed our key
+    @retrying.retry(stop_max_attempt_number=40,
+                    wait_exponential_multiplier=250,
+                    wait_exponential_max=5000,
+                    wait_jitter_max=500)
+    def _check_ssh(self):
+        with self.ssh() as conn:
+            conn.run("echo SSH is up for {}".format(self.ip_address))
 
     @property
     def private_key_path(self):
@@ -190,20 +303,78 @@ $user.SetInfo()""".format(fw_cmd=add_firewall_cmd,
 
     @contextmanager
     def ssh(self):
-        conn = Connection(
-            host=self.ip_address,
-            user=self.username,
-            connect_kwargs={
-                'key_filename': [self.private_key_path],
-            },
-            port=22,
-            connect_timeout=3,
-        )
-        try:
-            conn.open()
+        # Connections are pooled per VM; dead ones (e.g. after a reboot) are
+        # replaced transparently by the pool.
+        with self._ssh_pool.connection() as conn:
             yield conn
-        finally:
-            conn.close()
+
+    @property
+    def ssh_pool_stats(self):
+        if self._ssh_pool is None:
+            return None
+        return self._ssh_pool.stats
+
+    def close_ssh_connections(self):
+        """Close any pooled SSH connections (or the WinRM shell) to this VM.
+        """
+        if self._winrm_session is not None:
+            self._logger.info('WinRM session for %s opened %d shell(s)',
+                              self.ip_address,
+                              self._winrm_session.shells_opened)
+            self._winrm_session.close()
+            self._winrm_session = None
+        if self._remote_helper is not None:
+            self._remote_helper.close()
+            self._remote_helper = None
+        self._remote_helper_failed = False
+        if self._async_transport is not None:
+            self._async_transport.close()
+            self._async_transport = None
+        if self._ssh_pool is not None:
+            self._ssh_pool.log_stats()
+            self._ssh_pool.close()
+
+    def _get_remote_helper(self):
+        """Get the running remote helper for this VM, starting it if needed.
+        Returns None if the helper is not in use or could not be started, in
+        which case plain SSH should be used.
+        """
+        if (
+            self.windows
+            or not self.use_remote_helper
+            or self._remote_helper_failed
+        ):
+            return None
+        with self._remote_helper_lock:
+            if self._remote_helper_failed:
+                return None
+            if self._remote_helper is None:
+                with self.ssh() as fabric_ssh:
+                    python_path = fabric_ssh.run(
+                        'which python || which python3', hide=True,
+                        warn=True,
+                    ).stdout.strip()
+                helper = RemoteHelper(
+                    self._ssh_pool, self.username, python_path, self._logger,
+                    timeout=self._test_config['remote_helper_timeout'],
+                )
+                try:
+                    helper.start(get_helper_script_path())
+                except RemoteHelperDied as err:
+                    self._logger.warning('%s. Using plain SSH instead.', err)
+                    self._remote_helper_failed = True
+                    return None
+                self._remote_helper = helper
+            return self._remote_helper
+
+    def _remote_helper_fallback(self, err):
+        self._logger.warning(
+            'Remote helper request failed on %s, falling back to SSH: %s',
+            self.ip_address, err,
+        )
+        if isinstance(err, RemoteHelperDied):
+            # It will be restarted on next use
+            self._remote_helper = None
 
     def __str__(self):
         if self.is_manager:
@@ -218,10 +389,15 @@ $user.SetInfo()""".format(fw_cmd=add_firewall_cmd,
         self._logger.info('Stopping server.. [id=%s]', self.server_id)
         # Previously, we were calling stop_server on openstack, which allowed
         # clean shutdown
-        self.run_command('shutdown -h now', warn_only=True, use_sudo=True)
+        # This uses plain SSH because the remote helper won't survive it.
+        with self.ssh() as fabric_ssh:
+            fabric_ssh.sudo('shutdown -h now', warn=True)
+        # Pooled connections will not survive the shutdown
+        self.close_ssh_connections()
         while True:
             try:
-                self.run_command('echo Still up...')
+                with self.ssh() as fabric_ssh:
+                    fabric_ssh.run('echo Still up...')
                 time.sleep(3)
             except (SSHException, socket.timeout):
                 # Errors like 'Connection reset by peer' can occur during the
@@ -257,114 +433,408 @@ $user.SetInfo()""".format(fw_cmd=add_firewall_cmd,
         if self.windows:
             return 'windows'
 
-        self.put_remote_file_content(
-            '/tmp/get_distro',
-            '''#! {python}
-import platform
-
-distro, _, codename = platform.dist()
-print('{{}} {{}}'.format(distro, codename).lower())
-'''.format(python=self._get_python_path()))
-        self.run_command('chmod +x /tmp/get_distro')
-        return self.run_command('/tmp/get_distro').stdout.strip()
+        return self.run_command(
+            '{python} -c "import platform; '
+            'distro, _, codename = platform.dist(); '
+            'print(\'{{}} {{}}\'.format(distro, codename).lower())"'.format(
+                python=self._get_python_path(),
+            )
+        ).stdout.strip()
 
     @property
     def ssh_key(self):
         return self._ssh_key
 
-    def get_remote_file(self, remote_path, local_path):
-        """ Dump the contents of the remote file into the local path """
-        # Similar to the way fabric1 did it
-        remote_tmp = '/tmp/' + hashlib.sha1(
-            remote_path.encode('utf-8')).hexdigest()
-        self.run_command(
-            'cp {} {}'.format(remote_path, remote_tmp),
-            use_sudo=True,
+    def get_remote_file(self, remote_path, local_path, offset=0,
+                        length=None):
+        """ Dump the contents of the remote file into the local path.
+        offset and length select a byte range of the file (not on windows).
+        """
+        if self.windows and (offset or length is not None):
+            raise ValueError(
+                'Byte ranges of remote files cannot be retrieved from '
+                'windows hosts.'
+            )
+        with open(local_path, 'wb') as fh:
+            if self.windows:
+                self._get_windows_file(remote_path, fh)
+            else:
+                for chunk in self.iter_remote_file_content(
+                        remote_path, offset=offset, length=length):
+                    fh.write(chunk)
+
+    def _put_windows_file(self, remote_path, source):
+        start = time.time()
+        size = self._get_winrm_session().put_file(
+            remote_path, source,
+            chunk_size=self._test_config['windows_upload_chunk_size'],
         )
-        self.run_command(
-            'chmod 444 {}'.format(remote_tmp),
-            use_sudo=True,
+        self._logger.info('Uploaded %d bytes to %s:%s in %.1fs',
+                          size, self.ip_address, remote_path,
+                          time.time() - start)
+
+    def _get_windows_file(self, remote_path, destination):
+        start = time.time()
+        size = self._get_winrm_session().get_file(remote_path, destination)
+        self._logger.info('Downloaded %d bytes from %s:%s in %.1fs',
+                          size, self.ip_address, remote_path,
+                          time.time() - start)
+
+    def iter_remote_file_content(self, remote_path, offset=0, length=None,
+                                 max_size=None, chunk_size=65536):
+        """Stream the contents of a remote file as chunks of bytes.
+        The file is read with sudo over a single channel, without any
+        temporary files on either side.
+        offset and length select a byte range of the file.
+        max_size bounds the total amount of data that will be returned; the
+        iterator will stop once it has been reached.
+        """
+        if max_size is not None:
+            length = max_size if length is None else min(length, max_size)
+        # Each of these reads the file itself, so a missing or unreadable
+        # file fails the command rather than looking empty
+        if offset and length is not None:
+            command = (
+                'sudo dd if={} iflag=skip_bytes,count_bytes skip={} '
+                'count={} bs=64K status=none'.format(
+                    remote_path, offset, length)
+            )
+        elif offset:
+            command = 'sudo tail -c +{} {}'.format(offset + 1, remote_path)
+        elif length is not None:
+            command = 'sudo head -c {} {}'.format(length, remote_path)
+        else:
+            command = 'sudo cat {}'.format(remote_path)
+
+        with self.ssh() as fabric_ssh:
+            channel = fabric_ssh.open_session()
+            try:
+                channel.exec_command(command)
+                while True:
+                    chunk = channel.recv(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+                if channel.recv_exit_status() != 0:
+                    raise RemoteCommandError(
+                        'Could not read {path} on {ip}: {err}'.format(
+                            path=remote_path,
+                            ip=self.ip_address,
+                            err=channel.makefile_stderr().read().decode(
+                                'utf-8', 'replace'),
+                        )
+                    )
+            finally:
+                channel.close()
+
+    def put_remote_file(self, remote_path, local_path, owner=None,
+                        mode=None, check_hash=False):
+        """ Dump the contents of the local file into the remote path.
+        If owner or mode are supplied, they will be applied to the remote
+        file (they are ignored on windows).
+        If check_hash is set, the upload is skipped when the remote file
+        already has the same sha256 digest as the local one.
+        """
+        if self.windows:
+            with open(local_path, 'rb') as fh:
+                self._put_windows_file(remote_path, fh)
+        else:
+            digest = None
+            if check_hash:
+                digest = util.get_file_sha256(local_path)
+                if self._remote_file_is_current(remote_path, digest,
+                                                owner, mode):
+                    return
+            self._put_remote(remote_path, local_path, owner, mode)
+
+    def _get_remote_digests(self, remote_paths, cwd=None):
+        """Get the sha256 digests of remote files, keyed on the given paths
+        (relative to cwd, if it is set). Missing files are omitted.
+        """
+        remote_paths = [str(path) for path in remote_paths]
+        helper = self._get_remote_helper()
+        if helper:
+            full_paths = {
+                os.path.join(str(cwd or ''), path): path
+                for path in remote_paths
+            }
+            try:
+                return {
+                    full_paths[path]: digest
+                    for path, digest in helper.hash_files(
+                        list(full_paths)).items()
+                }
+            except RemoteHelperError as err:
+                self._remote_helper_fallback(err)
+        command = 'sha256sum {} 2>/dev/null'.format(
+            ' '.join(shlex.quote(path) for path in remote_paths))
+        if cwd:
+            command = 'cd {} && {}'.format(shlex.quote(str(cwd)), command)
+        result = self.run_command(command, use_sudo=True, warn_only=True,
+                                  hide_stdout=True)
+        digests = {}
+        for line in result.stdout.splitlines():
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                continue
+            digest, path = parts
+            path = path[1:] if path.startswith('*') else path
+            if digest.startswith('\\'):
+                # sha256sum escapes names containing newlines or backslashes
+                digest = digest[1:]
+                path = re.sub(r'\\(.)', lambda match: (
+                    '\n' if match.group(1) == 'n' else match.group(1)), path)
+            digests[path] = digest
+        return digests
+
+    def _remote_file_is_current(self, remote_path, digest, owner=None,
+                                mode=None):
+        remote_digests = list(self._get_remote_digests([remote_path]).values())
+        if remote_digests != [digest]:
+            return False
+
+        self._logger.info(
+            'Upload cache hit for %s:%s (already present), skipping upload.',
+            self.ip_address, remote_path,
+        )
+        fix_commands = []
+        if owner:
+            fix_commands.append('chown {} {}'.format(owner, remote_path))
+        if mode:
+            fix_commands.append('chmod {} {}'.format(mode, remote_path))
+        if fix_commands:
+            self.run_commands(fix_commands, use_sudo=True)
+        return True
+
+    def _put_remote(self, remote_path, source, owner=None, mode=None):
+        """Upload a local path or file-like object to the remote path.
+        The upload and the placement of the file (with sudo) both happen over
+        a single connection.
+        """
+        # Similar to the way fabric1 did it, but with a unique temporary
+        # path so that we don't need to clean up leftovers first.
+        remote_tmp = '/tmp/{}_{}'.format(
+            hashlib.sha1(remote_path.encode('utf-8')).hexdigest(),
+            uuid.uuid4().hex[:8],
         )
+        place_commands = [
+            'mkdir -p {}'.format(os.path.dirname(remote_path)),
+            'mv {} {}'.format(remote_tmp, remote_path),
+        ]
+        if owner:
+            place_commands.append('chown {} {}'.format(owner, remote_path))
+        if mode:
+            place_commands.append('chmod {} {}'.format(mode, remote_path))
 
         with self.ssh() as fabric_ssh:
-            fabric_ssh.get(
-                remote_tmp,
-                local_path,
+            fabric_ssh.put(source, remote_tmp)
+            # sudo only applies to the first command of a chain, so run the
+            # whole chain in a root shell
+            fabric_ssh.sudo('sh -c {}'.format(
+                shlex.quote(' && '.join(place_commands))))
+
+    def get_remote_file_content(self, remote_path, offset=0, length=None,
+                                max_size=None):
+        """Retrieve the contents of a remote file as a string.
+        offset and length select a byte range of the file.
+        If max_size is set and the content would be larger than that, a
+        ValueError will be raised. Use iter_remote_file_content to retrieve
+        large files in bounded chunks.
+        """
+        read_size = None if max_size is None else max_size + 1
+        if read_size is not None and (length is None or length > read_size):
+            length = read_size
+        content = None
+        helper = self._get_remote_helper()
+        if helper:
+            try:
+                content = helper.read_file(remote_path, offset, length)
+            except RemoteHelperError as err:
+                self._remote_helper_fallback(err)
+        if content is None:
+            content = b''.join(self.iter_remote_file_content(
+                remote_path, offset=offset, length=length,
+            ))
+        if max_size is not None and len(content) > max_size:
+            raise ValueError(
+                '{path} on {ip} is larger than {size} bytes.'.format(
+                    path=remote_path,
+                    ip=self.ip_address,
+                    size=max_size,
+                )
             )
+        return content.decode('utf-8')
 
-    def put_remote_file(self, remote_path, local_path):
-        """ Dump the contents of the local file into the remote path """
+    def put_remote_file_content(self, remote_path, content, owner=None,
+                                mode=None):
+        """Write the given content to the remote path.
+        If owner or mode are supplied, they will be applied to the remote
+        file (they are ignored on windows).
+        """
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
         if self.windows:
-            with open(local_path) as fh:
-                content = fh.read()
-            self.put_remote_file_content(remote_path, content)
+            self._put_windows_file(remote_path, io.BytesIO(content))
         else:
-            remote_tmp = '/tmp/' + hashlib.sha1(
-                remote_path.encode('utf-8')).hexdigest()
-            self.run_command(
-                'rm -rf {}'.format(remote_tmp),
-                use_sudo=True,
+            helper = self._get_remote_helper()
+            if helper:
+                try:
+                    helper.write_file(remote_path, content, owner, mode)
+                    return
+                except RemoteHelperError as err:
+                    self._remote_helper_fallback(err)
+            self._put_remote(remote_path, io.BytesIO(content), owner, mode)
+
+    @staticmethod
+    def _path_selected(rel_path, include=None, exclude=None):
+        """Check a relative path against include and exclude globs.
+        Globs are matched against both the relative path and the file name.
+        """
+        def _matches(patterns):
+            return any(
+                fnmatch.fnmatch(rel_path, pattern)
+                or fnmatch.fnmatch(os.path.basename(rel_path), pattern)
+                for pattern in patterns
             )
-            with self.ssh() as fabric_ssh:
-                # Similar to the way fabric1 did it
-                fabric_ssh.put(
-                    local_path,
-                    remote_tmp,
+        if include and not _matches(include):
+            return False
+        if exclude and _matches(exclude):
+            return False
+        return True
+
+    def put_directory(self, local_path, remote_path, include=None,
+                      exclude=None, use_sudo=False, check_hash=False):
+        """Copy a local directory tree into the remote path.
+        The tree is streamed as a compressed tar over a single channel, with
+        no intermediate archive on either side.
+        include and exclude are optional lists of globs to select files.
+        If check_hash is set, files which already exist remotely with the
+        same sha256 digest will not be sent.
+        """
+        local_path = str(local_path)
+        selected = []
+        for root, _, files in os.walk(local_path):
+            for name in sorted(files):
+                rel_path = os.path.relpath(os.path.join(root, name),
+                                           local_path)
+                if self._path_selected(rel_path, include, exclude):
+                    selected.append(rel_path)
+
+        digests = {}
+        if check_hash and selected:
+            digests = {
+                rel_path: util.get_file_sha256(
+                    os.path.join(local_path, rel_path))
+                for rel_path in selected
+            }
+            remote_digests = self._get_remote_digests(selected,
+                                                      cwd=remote_path)
+            unchanged = [
+                rel_path for rel_path in selected
+                if remote_digests.get(rel_path) == digests[rel_path]
+            ]
+            for rel_path in unchanged:
+                self._logger.info(
+                    'Upload cache hit for %s:%s, skipping upload.',
+                    self.ip_address, os.path.join(remote_path, rel_path),
                 )
-            self.run_command(
-                'mkdir -p {}'.format(
-                    os.path.dirname(remote_path),
-                ),
-                use_sudo=True,
-            )
-            self.run_command(
-                'mv {} {}'.format(remote_tmp, remote_path),
-                use_sudo=True,
-            )
-
-    def get_remote_file_content(self, remote_path):
-        tmp_local_path = os.path.join(self._tmpdir, str(uuid.uuid4()))
+            selected = [
+                rel_path for rel_path in selected
+                if rel_path not in unchanged
+            ]
+            if not selected:
+                return
 
-        try:
-            self.get_remote_file(remote_path, tmp_local_path)
-            with open(tmp_local_path, 'r') as f:
-                content = f.read()
-        finally:
-            if os.path.exists(tmp_local_path):
-                os.unlink(tmp_local_path)
-        return content
-
-    def put_remote_file_content(self, remote_path, content):
-        if self.windows:
-            self.run_command(
-                "Add-Content -Path {} -Value '{}'".format(
-                    remote_path,
-                    # Single quoted string will not be interpreted
-                    # But single quotes must be represented in such a string
-                    # with double single quotes
-                    content.replace("'", "''"),
-                ),
-                powershell=True,
-            )
-        else:
-            tmp_local_path = os.path.join(self._tmpdir, str(uuid.uuid4()))
+        sudo = 'sudo ' if use_sudo else ''
+        command = '{sudo}mkdir -p {dest} && {sudo}tar -xzf - -C {dest}'.format(
+            sudo=sudo, dest=shlex.quote(str(remote_path)),
+        )
+        if use_sudo:
+            command += ' --no-same-owner'
 
+        self._logger.info('Uploading directory %s to %s:%s',
+                          local_path, self.ip_address, remote_path)
+        with self.ssh() as fabric_ssh:
+            channel = fabric_ssh.open_session()
             try:
-                with open(tmp_local_path, 'w') as f:
-                    f.write(content)
-
-                self.put_remote_file(remote_path, tmp_local_path)
+                channel.exec_command(command)
+                stdin = channel.makefile('wb')
+                with tarfile.open(fileobj=stdin, mode='w|gz') as tar:
+                    for rel_path in selected:
+                        tar.add(os.path.join(local_path, rel_path),
+                                arcname=rel_path, recursive=False)
+                stdin.close()
+                channel.shutdown_write()
+                if channel.recv_exit_status() != 0:
+                    raise RemoteCommandError(
+                        'Could not extract {src} to {dest} on {ip}: '
+                        '{err}'.format(
+                            src=local_path,
+                            dest=remote_path,
+                            ip=self.ip_address,
+                            err=channel.makefile_stderr().read().decode(
+                                'utf-8', 'replace'),
+                        )
+                    )
+            finally:
+                channel.close()
+
+    def get_directory(self, remote_path, local_path, include=None,
+                      exclude=None, use_sudo=True):
+        """Copy a remote directory tree into the local path.
+        The tree is streamed as a compressed tar over a single channel, with
+        no intermediate archive on either side.
+        include and exclude are optional lists of globs to select files.
+        """
+        command = '{sudo}tar -czf - -C {src}'.format(
+            sudo='sudo ' if use_sudo else '',
+            src=shlex.quote(str(remote_path)),
+        )
+        for pattern in exclude or []:
+            command += ' --exclude={}'.format(shlex.quote(pattern))
+        command += ' .'
 
+        self._logger.info('Downloading directory %s:%s to %s',
+                          self.ip_address, remote_path, local_path)
+        util.mkdirs(str(local_path))
+        with self.ssh() as fabric_ssh:
+            channel = fabric_ssh.open_session()
+            try:
+                channel.exec_command(command)
+                stdout = channel.makefile('rb')
+                with tarfile.open(fileobj=stdout, mode='r|gz') as tar:
+                    for member in tar:
+                        # Parent directories are created on extraction
+                        if not member.isfile():
+                            continue
+                        rel_path = os.path.normpath(member.name)
+                        if rel_path.startswith('..') or os.path.isabs(
+                                rel_path):
+                            continue
+                        if not self._path_selected(rel_path, include,
+                                                   exclude):
+                            continue
+                        member.name = rel_path
+                        tar.extract(member, str(local_path), set_attrs=False)
+                status = channel.recv_exit_status()
+                # tar exits with 1 when files changed while being read,
+                # which is expected when collecting logs
+                if status not in (0, 1):
+                    raise RemoteCommandError(
+                        'Could not archive {src} on {ip}: {err}'.format(
+                            src=remote_path,
+                            ip=self.ip_address,
+                            err=channel.makefile_stderr().read().decode(
+                                'utf-8', 'replace'),
+                        )
+                    )
             finally:
-                if os.path.exists(tmp_local_path):
-                    os.unlink(tmp_local_path)
+                channel.close()
 
     def run_command(self, command, use_sudo=False, warn_only=False,
                     hide_stdout=False, powershell=False):
         if self.windows:
-            url = 'http://{host}:{port}/wsman'.format(host=self.ip_address,
-                                                      port=5985)
-            session = winrm.Session(url, auth=(self.username, self.password))
+            session = self._get_winrm_session()
             self._logger.info('Running command: %s', command)
             runner = session.run_ps if powershell else session.run_cmd
             result = runner(command)
@@ -377,6 +847,23 @@ print('{{}} {{}}'.format(distro, codename).lower())
             result.stdout = result.std_out
             return result
         else:
+            helper = self._get_remote_helper()
+            if helper:
+                try:
+                    return self._run_with_helper(helper, command, use_sudo,
+                                                 warn_only, hide_stdout)
+                except RemoteHelperLost as err:
+                    # The command may have run (or still be running), so it
+                    # must not be run again over SSH
+                    self._remote_helper = None
+                    raise RemoteCommandError(
+                        'Lost the remote helper on {ip} while running '
+                        '{command}: {err}'.format(
+                            ip=self.ip_address, command=command, err=err,
+                        )
+                    )
+                except RemoteHelperError as err:
+                    self._remote_helper_fallback(err)
             hide = 'stdout' if hide_stdout else None
             with self.ssh() as fabric_ssh:
                 if use_sudo:
@@ -384,6 +871,154 @@ print('{{}} {{}}'.format(distro, codename).lower())
                 else:
                     return fabric_ssh.run(command, warn=warn_only, hide=hide)
 
+    def _run_with_helper(self, helper, command, use_sudo, warn_only,
+                         hide_stdout):
+        """Run a command via the remote helper."""
+        return_code, stdout, stderr = helper.exec_command(command, use_sudo)
+        return self._command_result(command, return_code, stdout, stderr,
+                                    warn_only, hide_stdout)
+
+    @staticmethod
+    def _command_result(command, return_code, stdout, stderr, warn_only,
+                        hide_stdout):
+        """Build the same result (and raise the same error on failure) as
+        fabric would for a command that was run another way.
+        """
+        if not hide_stdout:
+            sys.stdout.write(stdout)
+        sys.stderr.write(stderr)
+        result = Result(
+            stdout=stdout,
+            stderr=stderr,
+            command=command,
+            exited=return_code,
+            hide=('stdout',) if hide_stdout else (),
+        )
+        if return_code != 0 and not warn_only:
+            raise UnexpectedExit(result)
+        return result
+
+    def _get_async_transport(self):
+        if self._async_transport is None:
+            self._async_transport = AsyncSSHTransport(
+                host=self.ip_address,
+                user=self.username,
+                key_filename=self.private_key_path,
+                logger=self._logger,
+            )
+        return self._async_transport
+
+    async def arun_command(self, command, use_sudo=False, warn_only=False,
+                           hide_stdout=False, powershell=False):
+        """Asyncio equivalent of run_command.
+        On linux this uses the asyncio ssh transport, so many commands can
+        be run concurrently from one thread. Windows commands are run in the
+        default executor.
+        """
+        if self.windows:
+            return await asyncio.get_event_loop().run_in_executor(
+                None, functools.partial(
+                    self.run_command, command, warn_only=warn_only,
+                    powershell=powershell,
+                )
+            )
+        return_code, stdout, stderr = await self._get_async_transport().run(
+            command, use_sudo=use_sudo)
+        return self._command_result(
+            command, return_code,
+            stdout.decode('utf-8', 'replace'),
+            stderr.decode('utf-8', 'replace'),
+            warn_only, hide_stdout,
+        )
+
+    async def aput_remote_file_content(self, remote_path, content,
+                                       owner=None, mode=None):
+        """Asyncio equivalent of put_remote_file_content."""
+        if self.windows:
+            await asyncio.get_event_loop().run_in_executor(
+                None, functools.partial(
+                    self.put_remote_file_content, remote_path, content,
+                )
+            )
+            return
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        await self._get_async_transport().put(remote_path, content,
+                                              owner=owner, mode=mode)
+
+    async def aget_remote_file_content(self, remote_path):
+        """Asyncio equivalent of get_remote_file_content."""
+        if self.windows:
+            content = await asyncio.get_event_loop().run_in_executor(
+                None, self.get_windows_remote_file_content, remote_path,
+            )
+            return content.decode('utf-8')
+        content = await self._get_async_transport().get(remote_path)
+        return content.decode('utf-8')
+
+    def run_commands(self, commands, use_sudo=False, stop_on_failure=True,
+                     warn_only=False, hide_stdout=False, powershell=False):
+        """Run an ordered batch of commands over a single connection.
+        Returns a list of CommandResult, one for each command that was run.
+        If stop_on_failure is set, no further commands will be run after the
+        first failing one.
+        Unless warn_only is set, a RemoteCommandError will be raised if any
+        command failed.
+        """
+        results = []
+        if self.windows:
+            for command in commands:
+                start = time.time()
+                result = self.run_command(command, warn_only=True,
+                                          powershell=powershell)
+                results.append(CommandResult(
+                    command, result.status_code, result.std_out,
+                    result.std_err, time.time() - start,
+                ))
+                if stop_on_failure and not results[-1].ok:
+                    break
+        elif self._get_remote_helper():
+            # Helper requests are cheap, so there's no connection to share
+            for command in commands:
+                start = time.time()
+                result = self.run_command(command, use_sudo=use_sudo,
+                                          warn_only=True,
+                                          hide_stdout=hide_stdout)
+                results.append(CommandResult(
+                    command, result.return_code, result.stdout,
+                    result.stderr, time.time() - start,
+                ))
+                if stop_on_failure and not results[-1].ok:
+                    break
+        else:
+            hide = 'stdout' if hide_stdout else None
+            with self.ssh() as fabric_ssh:
+                runner = fabric_ssh.sudo if use_sudo else fabric_ssh.run
+                for command in commands:
+                    start = time.time()
+                    result = runner(command, warn=True, hide=hide)
+                    results.append(CommandResult(
+                        command, result.return_code, result.stdout,
+                        result.stderr, time.time() - start,
+                    ))
+                    if stop_on_failure and not results[-1].ok:
+                        break
+
+        failed = [result for result in results if not result.ok]
+        if failed and not warn_only:
+            raise RemoteCommandError(
+                'Commands failed on {ip}: {cmds}'.format(
+                    ip=self.ip_address,
+                    cmds=', '.join(
+                        '{} (exit code {})'.format(result.command,
+                                                   result.return_code)
+                        for result in failed
+                    ),
+                ),
+                results,
+            )
+        return results
+
     @only_manager
     def upload_init_script_plugin(self, tenant_name='default_tenant'):
         self._logger.info('Uploading init script plugin to %s', tenant_name)
@@ -500,6 +1135,7 @@ print('{{}} {{}}'.format(distro, codename).lower())
                 self.put_remote_file(
                     '/tmp/test_valid_paying_license.yaml',
                     util.get_resource_path('test_valid_paying_license.yaml'),
+                    check_hash=True,
                 )
 
             if config_name:
@@ -533,11 +1169,117 @@ print('{{}} {{}}'.format(distro, codename).lower())
             fabric_ssh.run('nohup bash /tmp/bootstrap_script &>/dev/null &')
 
         if blocking:
-            while True:
-                if self.bootstrap_is_complete():
-                    break
-                else:
-                    time.sleep(5)
+            self.wait_for_bootstrap()
+
+    @only_manager
+    def wait_for_bootstrap(self, reconnect_attempts=5):
+        """Wait for a non-blocking bootstrap to complete.
+        The install logs are streamed over one SSH channel as they are
+        written, and this returns as soon as the bootstrap finishes.
+        """
+        if self.image_type == '5.0.5':
+            # Nothing was bootstrapped, see bootstrap
+            return
+        for attempt in range(reconnect_attempts):
+            try:
+                status = self._follow_bootstrap()
+            except (SSHException, socket.error, EOFError) as err:
+                self._logger.warning(
+                    'Lost bootstrap log stream from %s: %s',
+                    self.ip_address, err,
+                )
+                status = None
+            if status:
+                break
+            time.sleep(5)
+        else:
+            self._logger.warning(
+                'Could not stream bootstrap logs from %s, polling instead.',
+                self.ip_address,
+            )
+            while not self.bootstrap_is_complete():
+                time.sleep(5)
+            return
+
+        if status == 'done':
+            self._bootstrap_succeeded()
+        else:
+            self._bootstrap_failed()
+
+    def _follow_bootstrap(self):
+        """Log the bootstrap logs as they are written until the bootstrap
+        finishes, returning 'done' or 'failed'.
+        Returns None if the remote watcher exits without a result.
+        """
+        with self.ssh() as conn:
+            channel = conn.open_session()
+            try:
+                channel.settimeout(BOOTSTRAP_WATCH_TIMEOUT)
+                channel.set_combine_stderr(True)
+                channel.exec_command(
+                    'bash -c {}'.format(shlex.quote(BOOTSTRAP_WATCH_SCRIPT)))
+                partial = b''
+                while True:
+                    data = channel.recv(32768)
+                    if not data:
+                        return None
+                    lines = (partial + data).split(b'\n')
+                    partial = lines.pop()
+                    for line in lines:
+                        line = line.decode('utf-8', 'replace').rstrip()
+                        if line.startswith(BOOTSTRAP_STATUS_MARKER):
+                            status = line[len(BOOTSTRAP_STATUS_MARKER):]
+                            if status in ('done', 'failed'):
+                                return status
+                            self._logger.info('Bootstrap in progress...')
+                        elif line:
+                            self._logger.info(line)
+            finally:
+                channel.close()
+
+    def _bootstrap_succeeded(self):
+        self._logger.info('Bootstrap complete.')
+        try:
+            record_bootstrap_profile(
+                self.get_remote_file_content(BOOTSTRAP_INSTALL_LOG),
+                self._tmpdir,
+                self.ip_address,
+                self.image_type,
+                self._test_config['testing_version'],
+                self._test_config['bootstrap_profile_history'],
+                self._logger,
+            )
+        except Exception as err:
+            # The profile is only informational
+            self._logger.warning('Could not profile bootstrap of %s: %s',
+                                 self.ip_address, err)
+        self.finalize_preparation()
+
+    def _bootstrap_failed(self):
+        self._logger.error('BOOTSTRAP FAILED!')
+        with self.ssh() as fabric_ssh:
+            # Get all the logs on failure
+            fabric_ssh.run('cat /tmp/bs_logs/*')
+        try:
+            self.collect_logs()
+        except Exception as err:
+            self._logger.warning('Could not collect logs from %s: %s',
+                                 self.ip_address, err)
+        raise RuntimeError('Bootstrap failed.')
+
+    def collect_logs(self, local_path=None):
+        """Download the bootstrap logs and the cloudify logs of this VM,
+        each in one transfer, to local_path (by default, logs in this VM's
+        temporary directory).
+        """
+        local_path = local_path or os.path.join(self._tmpdir, 'logs')
+        for remote_path, name in LOG_DIRECTORIES:
+            if not self.run_command('test -d {}'.format(remote_path),
+                                    use_sudo=True, warn_only=True).ok:
+                continue
+            self.get_directory(remote_path, os.path.join(local_path, name))
+        self._logger.info('Collected logs from %s in %s',
+                          self.ip_address, local_path)
 
     @only_manager
     def bootstrap_is_complete(self):
@@ -555,20 +1297,14 @@ print('{{}} {{}}'.format(distro, codename).lower())
             ).stdout.strip()
 
             if result == 'done':
-                self._logger.info('Bootstrap complete.')
-                self.finalize_preparation()
+                self._bootstrap_succeeded()
                 return True
             else:
                 # To aid in troubleshooting (e.g. where a VM runs commands too
                 # slowly)
                 fabric_ssh.run('date > /tmp/cfy_mgr_last_check_time')
                 if result == 'failed':
-                    self._logger.error('BOOTSTRAP FAILED!')
-                    # Get all the logs on failure
-                    fabric_ssh.run(
-                        'cat /tmp/bs_logs/*'
-                    )
-                    raise RuntimeError('Bootstrap failed.')
+                    self._bootstrap_failed()
                 else:
                     fabric_ssh.run(
                         'tail -n5 /tmp/bs_logs/* || echo Waiting for logs'
@@ -703,7 +1439,10 @@ print('{{}} {{}}'.format(distro, codename).lower())
                 '/etc/sysconfig/network-scripts/ifcfg-eth{0}'.format(i),
                 network_file_path,
             )
-            self.run_command('ifup eth{0}'.format(i), use_sudo=True)
+        self.run_commands(
+            ['ifup eth{0}'.format(i) for i in range(0, len(self.networks))],
+            use_sudo=True,
+        )
 
     def _is_manager_image_type(self):
         if self.image_type == 'master':
@@ -808,23 +1547,30 @@ class Hosts(object):
         self._request = request
         self.tenant = None
         self.deployments = []
-        self.blueprints = []
+        # Content addressed IDs of the shared test blueprints, keyed on
+        # blueprint name
+        self.blueprint_ids = {}
         self.test_identifier = None
+        # Name of the infrastructure (networks, security group, keypair)
+        # the test VMs are deployed into
+        self.infrastructure_name = None
+        self.use_shared_infrastructure = self._test_config[
+            'infrastructure_manager']['shared_infrastructure']
+        self._shared_infrastructure = None
+        self.background_teardown = self._test_config['teardown'][
+            'background']
         self._test_vm_installs = {}
-        self._test_vm_uninstalls = {}
+        self.phase_timer = PhaseTimer(tmpdir)
+        self._install_start_times = {}
+        # Leases of warm pool VMs, keyed on instance index
+        self._pool_leases = {}
         self._platform_resource_ids = {}
 
         self.multi_net = multi_net
         self.vm_net_mappings = vm_net_mappings or {}
 
-        infra_mgr_config = self._test_config['infrastructure_manager']
-        self._infra_client = util.create_rest_client(
-            infra_mgr_config['address'],
-            username='admin',
-            password=infra_mgr_config['admin_password'],
-            cert=infra_mgr_config['ca_cert'],
-            protocol='https' if infra_mgr_config['ca_cert'] else 'http',
-        )
+        self._infra_client = create_infrastructure_manager_client(
+            self._test_config['infrastructure_manager'])
 
         if flavor:
             self.server_flavor = flavor
@@ -850,36 +1596,51 @@ class Hosts(object):
             time=datetime.strftime(datetime.now(), '%Y%m%d%H%M%S'),
         )
         self.test_identifier = test_identifier
+        self.phase_timer.test_identifier = test_identifier
 
         try:
-            self._logger.info('Creating test tenant')
-            self._infra_client.tenants.create(test_identifier)
-            self._infra_client._client.headers[
-                CLOUDIFY_TENANT_HEADER] = test_identifier
-            self.tenant = test_identifier
-
-            self._upload_secrets_to_infrastructure_manager()
-            self._upload_plugins_to_infrastructure_manager()
-            self._upload_blueprints_to_infrastructure_manager()
-
-            self._deploy_test_infrastructure(test_identifier)
-
-            # Deploy hosts in parallel
-            for index, instance in enumerate(self.instances):
-                self._start_deploy_test_vm(instance.image_name, index,
-                                           test_identifier,
-                                           instance.is_manager)
-            self._finish_deploy_test_vms()
-
-            for instance in self.instances:
-                if instance.is_manager and not instance.bootstrappable:
-                    # A pre-bootstrapped manager is desired for this test,
-                    # let's make it happen.
+            leased = self._lease_pooled_vms()
+            to_deploy = [index for index in range(len(self.instances))
+                         if index not in leased]
+
+            if to_deploy:
+                self._create_test_infrastructure(test_identifier)
+                self._deploy_instances(to_deploy)
+
+            with self.phase_timer.phase('wait_for_ssh'):
+                self.wait_for_ssh()
+
+            # A pre-bootstrapped manager is desired for these, so let's make
+            # it happen. All the bootstraps are started before waiting for
+            # any of them.
+            to_bootstrap = [
+                instance for instance in self.instances
+                if instance.is_manager and not instance.bootstrappable
+            ]
+
+            def _start_bootstrap(instance):
+                with self.phase_timer.phase('start_bootstrap',
+                                            instance.server_index):
                     instance.bootstrap(
-                        upload_license=self._test_config['premium'])
+                        upload_license=self._test_config['premium'],
+                        blocking=False,
+                    )
+
+            util.run_in_parallel(_start_bootstrap, to_bootstrap,
+                                 logger=self._logger)
 
+            def _finish_preparation(instance):
+                if instance in to_bootstrap:
+                    with self.phase_timer.phase('wait_for_bootstrap',
+                                                instance.server_index):
+                        instance.wait_for_bootstrap()
                 if instance.should_finalize:
-                    instance.finalize_preparation()
+                    with self.phase_timer.phase('finalize_preparation',
+                                                instance.server_index):
+                        instance.finalize_preparation()
+
+            util.run_in_parallel(_finish_preparation, self.instances,
+                                 logger=self._logger)
         except Exception as err:
             self._logger.error(
                 "Encountered exception trying to create test resources: %s.\n"
@@ -888,8 +1649,160 @@ class Hosts(object):
             self.destroy()
             raise
 
+    def _create_test_infrastructure(self, test_identifier):
+        self._logger.info('Creating test tenant')
+        with self.phase_timer.phase('create_tenant'):
+            self._infra_client.tenants.create(test_identifier)
+        self._infra_client._client.headers[
+            CLOUDIFY_TENANT_HEADER] = test_identifier
+        self.tenant = test_identifier
+
+        with self.phase_timer.phase('upload_secrets'):
+            self._upload_secrets_to_infrastructure_manager()
+        with self.phase_timer.phase('check_plugins'):
+            self._upload_plugins_to_infrastructure_manager()
+
+        if self.use_shared_infrastructure:
+            # Imported here as the shared infrastructure is built on Hosts
+            from cosmo_tester.framework.shared_infrastructure import (
+                acquire_shared_infrastructure,
+            )
+            with self.phase_timer.phase('upload_blueprints'):
+                self._upload_blueprints_to_infrastructure_manager(
+                    infrastructure=False)
+            with self.phase_timer.phase('acquire_shared_infrastructure'):
+                shared = acquire_shared_infrastructure(
+                    self._test_config, self._logger, self.multi_net)
+            self._shared_infrastructure = shared
+            self.infrastructure_name = shared.name
+            self.network_mappings = shared.network_mappings
+            self._platform_resource_ids = dict(shared.platform_resource_ids)
+        else:
+            with self.phase_timer.phase('upload_blueprints'):
+                self._upload_blueprints_to_infrastructure_manager()
+            with self.phase_timer.phase('deploy_infrastructure'):
+                self._deploy_test_infrastructure(test_identifier)
+            self.infrastructure_name = test_identifier
+
+    def _deploy_instances(self, indices):
+        """Deploy the VMs for the instances at the given indices."""
+        # Deploy hosts in parallel
+        util.run_in_parallel(
+            lambda index: self._start_deploy_test_vm(
+                self.instances[index].image_name, index,
+                self.instances[index].is_manager,
+            ),
+            indices,
+            max_workers=self._test_config['infrastructure_manager'][
+                'deployment_concurrency'],
+            logger=self._logger,
+        )
+        self._finish_deploy_test_vms(indices)
+
+    def _lease_pooled_vms(self):
+        """Lease ready VMs from the warm VM pool for any instances that can
+        use one. Returns the leases, keyed on instance index.
+        """
+        # Imported here as the pool itself is built on Hosts
+        from cosmo_tester.framework.vm_pool import get_vm_pool
+
+        pool = get_vm_pool(self._test_config, self._logger)
+        if pool is None or self.multi_net:
+            return {}
+
+        for index, instance in enumerate(self.instances):
+            if not pool.can_provide(instance):
+                continue
+            with self.phase_timer.phase('lease_pooled_vm', index):
+                lease = pool.lease(instance.image_type, self.server_flavor,
+                                   self._ssh_key)
+            if lease is None:
+                continue
+            pooled = lease.vm
+            instance.assign(
+                pooled.ip_address,
+                pooled.private_ip_address,
+                {},
+                self._ssh_key,
+                self._logger,
+                self._tmpdir,
+                pooled.node_instance_id,
+                pooled.deployment_id,
+                pooled.server_id,
+                index,
+            )
+            self._pool_leases[index] = lease
+        return self._pool_leases
+
+    def run_on_all(self, command, instances=None, max_workers=None,
+                   use_sudo=False, warn_only=False, hide_stdout=False,
+                   use_asyncio=False):
+        """Run a command on several instances concurrently.
+        command can be a string or a callable which takes an instance and
+        returns the command to run on it.
+        instances defaults to all instances of these hosts.
+        Returns the results in the same order as the instances. Failures on
+        any host are aggregated into a single util.ParallelExecutionError.
+        If use_asyncio is set, the asyncio transport is used instead of a
+        thread for each instance (max_workers is then ignored).
+        """
+        if use_asyncio:
+            return run_sync(self.arun_on_all(
+                command, instances=instances, use_sudo=use_sudo,
+                warn_only=warn_only, hide_stdout=hide_stdout,
+            ))
+        if instances is None:
+            instances = self.instances
+
+        def _run(instance):
+            instance_command = (
+                command(instance) if callable(command) else command
+            )
+            return instance.run_command(instance_command, use_sudo=use_sudo,
+                                        warn_only=warn_only,
+                                        hide_stdout=hide_stdout)
+
+        return util.run_in_parallel(_run, instances, max_workers,
+                                    logger=self._logger)
+
+    async def arun_on_all(self, command, instances=None, use_sudo=False,
+                          warn_only=False, hide_stdout=False):
+        """Asyncio equivalent of run_on_all."""
+        if instances is None:
+            instances = self.instances
+
+        def _run(instance):
+            return instance.arun_command(
+                command(instance) if callable(command) else command,
+                use_sudo=use_sudo, warn_only=warn_only,
+                hide_stdout=hide_stdout,
+            )
+
+        return await gather_in_parallel(_run, instances, self._logger)
+
+    def wait_for_ssh(self, instances=None, max_workers=None):
+        """Wait for SSH to be available on several instances concurrently.
+        The SSH ports of all instances are probed together before the SSH
+        sessions are checked in parallel.
+        """
+        if instances is None:
+            instances = self.instances
+        instances = [instance for instance in instances
+                     if instance.enable_ssh_wait]
+        util.wait_for_tcp_ports(
+            [(instance.ip_address, 22) for instance in instances],
+            logger=self._logger,
+        )
+        util.run_in_parallel(
+            lambda instance: instance.wait_for_ssh(probe_port=False),
+            instances, max_workers, logger=self._logger,
+        )
+
     def destroy(self, passed=None):
         """Destroys the infrastructure. """
+        for instance in self.instances:
+            instance.close_ssh_connections()
+
         if passed is None:
             try:
                 passed = self._request.session.testspassed
@@ -917,96 +1830,35 @@ class Hosts(object):
                 return
 
         self._logger.info('Destroying test hosts..')
-        if self.tenant:
-            self._logger.info('Ensuring executions are stopped.')
-            cancelled = []
-            execs = self._infra_client.executions.list()
-            for execution in execs:
-                if execution['workflow_id'] != (
-                    'create_deployment_environment'
-                ):
-                    self._logger.info(
-                        'Ensuring %s (%s) is not running.',
-                        execution['id'],
-                        execution['workflow_id'],
-                    )
-                    self._infra_client.executions.cancel(
-                        execution['id'], force=True, kill=True
-                    )
-                    cancelled.append(execution['id'])
-                else:
-                    self._logger.info(
-                        'Skipping %s (%s).',
-                        execution['id'],
-                        execution['workflow_id'],
-                    )
+        with self.phase_timer.phase('release_pooled_vms'):
+            for lease in self._pool_leases.values():
+                lease.release()
+        self._pool_leases = {}
 
-            cancel_complete = []
-            for execution_id in cancelled:
-                self._logger.info('Checking {} is cancelled.'.format(
-                    execution_id,
-                ))
-                for _ in range(30):
-                    execution = self._infra_client.executions.get(
-                        execution_id)
-                    self._logger.info('{} is in state {}.'.format(
-                        execution_id,
-                        execution['status'],
-                    ))
-                    if execution['status'] == 'cancelled':
-                        cancel_complete.append(execution_id)
-                        break
-                    else:
-                        time.sleep(3)
-
-            cancel_failures = set(cancelled).difference(cancel_complete)
-            if cancel_failures:
-                self._logger.error(
-                    'Teardown failed due to the following executions not '
-                    'entering the correct state after kill-cancel: {}'.format(
-                        ', '.join(cancel_failures),
-                    )
-                )
-                raise RuntimeError('Could not complete teardown.')
-
-            self._start_undeploy_test_vms()
-            self._finish_undeploy_test_vms()
-
-            self._logger.info('Uninstalling infrastructure')
-            util.run_blocking_execution(
-                self._infra_client, 'infrastructure', 'uninstall',
-                self._logger)
-            util.delete_deployment(self._infra_client, 'infrastructure',
-                                   self._logger)
-
-            self._logger.info('Deleting blueprints.')
-            for blueprint in self.blueprints:
-                self._logger.info('Deleting %s', blueprint)
-                self._infra_client.blueprints.delete(blueprint)
-
-            self._logger.info('Deleting plugins.')
-            plugins = self._infra_client.plugins.list()
-            for plugin in plugins:
-                if plugin["tenant_name"] != self.tenant:
-                    self._logger.info(
-                        'Skipping shared %s (%s)',
-                        plugin['package_name'],
-                        plugin['id'],
-                    )
-                else:
-                    self._logger.info(
-                        'Deleting %s (%s)',
-                        plugin['package_name'],
-                        plugin['id'],
+        if self.tenant:
+            if self.background_teardown:
+                with self.phase_timer.phase('submit_background_teardown'):
+                    get_reaper(self._test_config, self._logger).submit(
+                        self._test_config['infrastructure_manager'],
+                        self.tenant,
+                        self.deployments,
                     )
-                    self._infra_client.plugins.delete(plugin['id'])
-
-            self._logger.info('Deleting tenant %s', self.tenant)
+            else:
+                with self.phase_timer.phase('teardown_tenant'):
+                    teardown_tenant(self._infra_client, self.tenant,
+                                    self._logger, self.phase_timer)
             self._infra_client._client.headers[
                 CLOUDIFY_TENANT_HEADER] = 'default_tenant'
-            self._infra_client.tenants.delete(self.tenant)
             self.tenant = None
 
+        if self._shared_infrastructure:
+            from cosmo_tester.framework.shared_infrastructure import (
+                release_shared_infrastructure,
+            )
+            with self.phase_timer.phase('release_shared_infrastructure'):
+                release_shared_infrastructure(self._shared_infrastructure)
+            self._shared_infrastructure = None
+
     def _upload_secrets_to_infrastructure_manager(self):
         self._logger.info(
             'Uploading secrets to infrastructure manager.'
@@ -1014,16 +1866,16 @@ class Hosts(object):
         mappings = self._test_config.platform.get(
             'secrets_mapping', {})
 
-        for secret_name, mapping in mappings.items():
-            self._infra_client.secrets.create(
-                secret_name, self._test_config.platform[mapping],
-            )
+        secrets = {
+            secret_name: self._test_config.platform[mapping]
+            for secret_name, mapping in mappings.items()
+        }
 
         with open(self._ssh_key.public_key_path) as ssh_pubkey_handle:
-            ssh_pubkey = ssh_pubkey_handle.read()
-        self._infra_client.secrets.create(
-            "ssh_public_key", ssh_pubkey,
-        )
+            secrets["ssh_public_key"] = ssh_pubkey_handle.read()
+
+        util.create_secrets(self._infra_client, secrets, self.tenant,
+                            self._logger)
 
     def _upload_plugins_to_infrastructure_manager(self):
         plugin_details = self._test_config.platform
@@ -1043,42 +1895,42 @@ class Hosts(object):
                 )
             )
 
-    def _upload_blueprints_to_infrastructure_manager(self):
+    def _upload_blueprints_to_infrastructure_manager(
+            self, infrastructure=True):
         self._logger.info(
             'Uploading test blueprints to infrastructure manager.'
         )
-        suffix = '-multi-net' if self.multi_net else ""
-        self._infra_client.blueprints.upload(
-            util.get_resource_path(
-                'infrastructure_blueprints/{}/infrastructure{}.yaml'.format(
-                    self._test_config['target_platform'],
-                    suffix,
-                )
-            ),
-            "infrastructure",
-            async_upload=True
-        )
-        util.wait_for_blueprint_upload(self._infra_client, "infrastructure")
-
-        self.blueprints.append('infrastructure')
-        test_vm_suffixes = ['']
+        # Blueprints are shared between all tenants, so this usually only
+        # has to find the ones uploaded by earlier tests
+        blueprint_files = {'test_vm': 'vm.yaml'}
         if self.multi_net:
-            test_vm_suffixes.append('-multi-net')
+            blueprint_files['test_vm-multi-net'] = 'vm-multi-net.yaml'
+        if infrastructure:
+            blueprint_files['infrastructure'] = 'infrastructure{}.yaml'.format(
+                '-multi-net' if self.multi_net else '',
+            )
 
-        for suffix in test_vm_suffixes:
-            blueprint_id = "test_vm{}".format(suffix)
-            self._infra_client.blueprints.upload(
+        names = sorted(blueprint_files)
+        # A client of its own, as the uploads switch it to the default tenant
+        # while other threads may be using the test tenant's client
+        upload_client = create_infrastructure_manager_client(
+            self._test_config['infrastructure_manager'])
+        blueprint_ids = util.run_in_parallel(
+            lambda name: util.upload_blueprint_by_hash(
+                upload_client,
                 util.get_resource_path(
-                    'infrastructure_blueprints/{}/vm{}.yaml'.format(
+                    'infrastructure_blueprints/{}/{}'.format(
                         self._test_config['target_platform'],
-                        suffix,
+                        blueprint_files[name],
                     )
                 ),
-                blueprint_id,
-                async_upload=True
-            )
-            util.wait_for_blueprint_upload(self._infra_client, blueprint_id)
-            self.blueprints.append('test_vm{}'.format(suffix))
+                name,
+                self._logger,
+            ),
+            names,
+            logger=self._logger,
+        )
+        self.blueprint_ids.update(zip(names, blueprint_ids))
 
     def _deploy_test_infrastructure(self, test_identifier):
         self._logger.info('Creating test infrastructure inputs.')
@@ -1100,8 +1952,8 @@ class Hosts(object):
             'Creating test infrastructure using infrastructure manager.'
         )
         util.create_deployment(
-            self._infra_client, 'infrastructure', 'infrastructure',
-            self._logger, inputs=infrastructure_inputs,
+            self._infra_client, self.blueprint_ids['infrastructure'],
+            'infrastructure', self._logger, inputs=infrastructure_inputs,
         )
         self.deployments.append('infrastructure')
         util.run_blocking_execution(
@@ -1128,8 +1980,7 @@ class Hosts(object):
         if self._test_config['target_platform'] == 'aws':
             self._populate_aws_platform_properties()
 
-    def _start_deploy_test_vm(self, image_id, index, test_identifier,
-                              is_manager):
+    def _start_deploy_test_vm(self, image_id, index, is_manager):
         self._logger.info(
             'Preparing to deploy instance %d of image %s',
             index,
@@ -1149,9 +2000,21 @@ class Hosts(object):
 
         self._logger.info('Creating test VM inputs for %s_%d',
                           image_id, index)
+        userdata = self.instances[index].userdata
+        if self._shared_infrastructure and not (
+            userdata or self.instances[index].windows
+        ):
+            # The shared infrastructure's keypair is not made from our key,
+            # so have cloud-init authorize it instead
+            with open(self._ssh_key.public_key_path) as ssh_pubkey_handle:
+                userdata = (
+                    '#cloud-config\n'
+                    'ssh_authorized_keys:\n'
+                    '  - {}\n'.format(ssh_pubkey_handle.read().strip())
+                )
         vm_inputs = {
-            'test_infrastructure_name': test_identifier,
-            'userdata': self.instances[index].userdata,
+            'test_infrastructure_name': self.infrastructure_name,
+            'userdata': userdata,
             'flavor': self.server_flavor,
         }
         if self._test_config['target_platform'] == 'openstack':
@@ -1193,10 +2056,11 @@ class Hosts(object):
             inp_handle.write(json.dumps(vm_inputs))
 
         self._logger.info('Deploying instance %d of %s', index, image_id)
-        util.create_deployment(
-            self._infra_client, blueprint_id, vm_id, self._logger,
-            inputs=vm_inputs,
-        )
+        with self.phase_timer.phase('create_deployment', index):
+            util.create_deployment(
+                self._infra_client, self.blueprint_ids[blueprint_id], vm_id,
+                self._logger, inputs=vm_inputs,
+            )
         self.deployments.append(vm_id)
         self._test_vm_installs[vm_id] = (
             self._infra_client.executions.start(
@@ -1204,42 +2068,53 @@ class Hosts(object):
             ),
             index,
         )
+        self._install_start_times[vm_id] = time.time()
 
     def _populate_aws_platform_properties(self):
         self._logger.info('Retrieving AWS resource IDs')
-        resource_ids = {}
+        node_instances = util.get_node_instance_index(self._infra_client,
+                                                      'infrastructure')
 
-        subnet = util.get_node_instances(
-            'test_subnet_1', 'infrastructure', self._infra_client)[0]
-        resource_ids['subnet_id'] = subnet['runtime_properties'][
-            'aws_resource_id']
-        if self.multi_net:
-            subnet_2 = util.get_node_instances(
-                'test_subnet_2', 'infrastructure', self._infra_client)[0]
-            resource_ids['subnet_2_id'] = subnet_2['runtime_properties'][
-                'aws_resource_id']
-            subnet_3 = util.get_node_instances(
-                'test_subnet_3', 'infrastructure', self._infra_client)[0]
-            resource_ids['subnet_3_id'] = subnet_3['runtime_properties'][
+        def _get_resource_id(node_id):
+            return node_instances[node_id][0]['runtime_properties'][
                 'aws_resource_id']
 
-        vpc = util.get_node_instances(
-            'vpc', 'infrastructure', self._infra_client)[0]
-        resource_ids['vpc_id'] = vpc['runtime_properties']['aws_resource_id']
-        security_group = util.get_node_instances(
-            'security_group', 'infrastructure', self._infra_client)[0]
-        resource_ids['security_group_id'] = security_group[
-            'runtime_properties']['aws_resource_id']
+        resource_ids = {'subnet_id': _get_resource_id('test_subnet_1')}
+        if self.multi_net:
+            resource_ids['subnet_2_id'] = _get_resource_id('test_subnet_2')
+            resource_ids['subnet_3_id'] = _get_resource_id('test_subnet_3')
+        resource_ids['vpc_id'] = _get_resource_id('vpc')
+        resource_ids['security_group_id'] = _get_resource_id(
+            'security_group')
 
         self._platform_resource_ids = resource_ids
 
-    def _finish_deploy_test_vms(self):
-        for vm_id, details in self._test_vm_installs.items():
-            execution, index = details
-            util.wait_for_execution(self._infra_client, execution,
-                                    self._logger)
+    def _finish_deploy_test_vms(self, indices=None):
+        installs = {
+            execution['id']: (vm_id, index)
+            for vm_id, (execution, index) in self._test_vm_installs.items()
+            if indices is None or index in indices
+        }
+        for execution in util.wait_for_executions(
+                self._infra_client,
+                [execution for execution, index in
+                 self._test_vm_installs.values()
+                 if indices is None or index in indices],
+                self._logger):
+            vm_id, index = installs[execution.id]
+            install_start = self._install_start_times[vm_id]
+            self.phase_timer.record(
+                'install', install_start, time.time() - install_start,
+                'success' if execution.status == execution.TERMINATED
+                else 'failure',
+                index,
+            )
+            if execution.status != execution.TERMINATED:
+                # Failures are raised once all installs have finished
+                continue
 
-            self._logger.info('Retrieving deployed instance details.')
+            self._logger.info('Retrieving deployed instance details for %s.',
+                              vm_id)
             node_instance = util.get_node_instances('test_host', vm_id,
                                                     self._infra_client)[0]
 
@@ -1249,22 +2124,23 @@ class Hosts(object):
                 node_instance,
             )
 
-    def _start_undeploy_test_vms(self):
-        # Operate on all deployments except the infrastructure one
-        for vm_id in self.deployments[1:]:
-            self._logger.info('Uninstalling %s', vm_id)
-            self._test_vm_uninstalls[vm_id] = (
-                self._infra_client.executions.start(
-                    vm_id, 'uninstall',
-                )
+        for vm_id, index in sorted(installs.values()):
+            self._logger.info(
+                'Deployment phase timings for %s: %s', vm_id,
+                ', '.join(
+                    '{}: {:.1f}s'.format(phase, duration)
+                    for phase, duration in
+                    self.phase_timer.instance_durations(index).items()
+                ),
             )
 
-    def _finish_undeploy_test_vms(self):
-        for vm_id, execution in self._test_vm_uninstalls.items():
-            util.wait_for_execution(self._infra_client, execution,
+    def _undeploy_test_vm(self, vm_id):
+        """Uninstall and delete a single test VM deployment."""
+        self._logger.info('Uninstalling %s', vm_id)
+        util.run_blocking_execution(self._infra_client, vm_id, 'uninstall',
                                     self._logger)
-            util.delete_deployment(self._infra_client, vm_id,
-                                   self._logger)
+        util.delete_deployment(self._infra_client, vm_id, self._logger)
+        self.deployments.remove(vm_id)
 
     def _update_instance(self, server_index, node_instance):
         instance = self.instances[server_index]
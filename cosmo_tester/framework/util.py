@@ -1,18 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+import copy
 from datetime import datetime, timedelta
 import errno
 import glob
+import hashlib
 import json
 import logging
 import os
+import random
 import requests
 import retrying
+import selectors
 import shlex
 import socket
 import subprocess
 import sys
 from tempfile import mkstemp
+import threading
 import time
+import weakref
 import yaml
 
 from cloudify_rest_client import CloudifyClient
@@ -27,6 +34,10 @@ from cosmo_tester import resources
 from cosmo_tester.framework.constants import CLOUDIFY_TENANT_HEADER
 from cosmo_tester.framework.exceptions import ProcessExecutionError
 
+# Memoized node instance indexes, keyed on client then (tenant, deployment ID)
+_node_instance_indexes = weakref.WeakKeyDictionary()
+_node_instance_indexes_lock = threading.Lock()
+
 
 def pass_stdout(line, input_queue, process):
     output = line.encode(process.call_args['encoding'], 'replace')
@@ -164,6 +175,45 @@ def set_client_tenant(client, tenant):
             client._client.headers[CLOUDIFY_TENANT_HEADER] = original
 
 
+def create_secrets(client, secrets, tenant, logger):
+    """Create the given secrets (a dict of key: value) in a tenant, replacing
+    any that already exist.
+    They are sent in one bulk import request, or created concurrently if the
+    manager does not support importing secrets.
+    """
+    secrets_list = [
+        {
+            'key': key,
+            'value': value,
+            'tenant_name': tenant,
+            'visibility': 'tenant',
+            'is_hidden_value': False,
+            'encrypted': False,
+        }
+        for key, value in secrets.items()
+    ]
+    try:
+        result = client.secrets.import_secrets(secrets_list,
+                                               override_collisions=True)
+    except CloudifyClientError as err:
+        if err.status_code not in (404, 405):
+            raise
+        logger.info('Secrets import is not supported by the manager, '
+                    'creating secrets individually.')
+    else:
+        if not result.get('secrets_errors'):
+            return
+        logger.warning('Secrets import reported errors, creating secrets '
+                       'individually instead: %s', result['secrets_errors'])
+
+    with set_client_tenant(client, tenant):
+        run_in_parallel(
+            lambda key: client.secrets.create(key, secrets[key],
+                                              update_if_exists=True),
+            sorted(secrets), logger=logger,
+        )
+
+
 def prepare_and_get_test_tenant(test_param, manager, test_config):
     """
         Prepares a tenant for testing based on the test name (or other
@@ -228,6 +278,115 @@ def run(command, retries=0, stdin=b'', ignore_failures=False,
     return proc
 
 
+class PortWaitTimeout(Exception):
+    """Timed out waiting for TCP ports to accept connections."""
+
+
+def wait_for_tcp_ports(addresses, timeout=300, connect_timeout=3,
+                       initial_delay=0.5, max_delay=10, logger=logging):
+    """Wait until every (host, port) in addresses accepts TCP connections.
+    All addresses are probed at once using non-blocking connects, retrying
+    failed ones with exponential backoff and jitter.
+    """
+    addresses = set((str(host), port) for host, port in addresses)
+    if not addresses:
+        return
+    logger.info('Waiting for ports to open on: %s', ', '.join(
+        '{}:{}'.format(host, port) for host, port in sorted(addresses)))
+
+    start = time.time()
+    selector = selectors.DefaultSelector()
+    next_attempt = {address: start for address in addresses}
+    delays = {address: initial_delay for address in addresses}
+    in_flight = {}
+
+    def _retry_later(address):
+        delays[address] = min(delays[address] * 2, max_delay)
+        next_attempt[address] = time.time() + random.uniform(
+            delays[address] / 2, delays[address])
+
+    try:
+        while next_attempt:
+            now = time.time()
+            if now - start > timeout:
+                raise PortWaitTimeout(
+                    'Timed out waiting for: {}'.format(', '.join(
+                        '{}:{}'.format(host, port)
+                        for host, port in sorted(next_attempt)
+                    ))
+                )
+
+            for address, when in list(next_attempt.items()):
+                if when > now or address in in_flight.values():
+                    continue
+                try:
+                    family, socktype, proto, _, sockaddr = (
+                        socket.getaddrinfo(address[0], address[1],
+                                           0, socket.SOCK_STREAM)[0]
+                    )
+                    sock = socket.socket(family, socktype, proto)
+                except socket.error:
+                    _retry_later(address)
+                    continue
+                sock.setblocking(False)
+                result = sock.connect_ex(sockaddr)
+                if result == 0:
+                    sock.close()
+                    next_attempt.pop(address)
+                elif result in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    in_flight[sock] = address
+                    selector.register(sock, selectors.EVENT_WRITE,
+                                      now + connect_timeout)
+                else:
+                    sock.close()
+                    _retry_later(address)
+
+            # Sleep until the next address is due a connection attempt, or
+            # the next in flight attempt times out
+            connecting = set(in_flight.values())
+            wake_times = [when for address, when in next_attempt.items()
+                          if address not in connecting]
+            wake_times.extend(key.data
+                              for key in selector.get_map().values())
+            wait = 0.5
+            if wake_times:
+                wait = max(0, min(wait, min(wake_times) - now))
+            ready = set()
+            if in_flight:
+                for key, _ in selector.select(timeout=wait):
+                    ready.add(key.fileobj)
+            else:
+                time.sleep(wait)
+
+            now = time.time()
+            for key in list(selector.get_map().values()):
+                sock = key.fileobj
+                if sock not in ready and key.data > now:
+                    continue
+                address = in_flight.pop(sock)
+                selector.unregister(sock)
+                if sock in ready and sock.getsockopt(
+                        socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    next_attempt.pop(address)
+                    logger.info('%s:%s is accepting connections.',
+                                *address)
+                else:
+                    _retry_later(address)
+                sock.close()
+    finally:
+        for sock in in_flight:
+            sock.close()
+        selector.close()
+
+
+def get_file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def write_to_tempfile(contents, json_dump=False):
     fd, file_path = mkstemp()
     os.close(fd)
@@ -394,6 +553,19 @@ def generate_ca_cert(ca_cert_path, ca_key_path):
     ])
 
 
+class GeneratedSSHKey(object):
+    """An SSH key pair generated for the framework's own use, e.g. for VMs
+    which outlive a single test module.
+    """
+
+    def __init__(self, tmpdir, name):
+        self.private_key_path = tmpdir / '{}.pem'.format(name)
+        self.public_key_path = tmpdir / '{}.pem.pub'.format(name)
+        run(['ssh-keygen', '-t', 'rsa', '-q', '-N', '',
+             '-f', str(self.private_key_path)])
+        os.chmod(self.private_key_path, 0o400)
+
+
 class ExecutionTimeout(Exception):
     """Execution timed out."""
 
@@ -402,6 +574,14 @@ class ExecutionFailed(Exception):
     """Execution failed."""
 
 
+class ExecutionsFailed(ExecutionFailed):
+    """One or more of several executions failed or timed out."""
+    def __init__(self, message, failures):
+        super(ExecutionsFailed, self).__init__(message)
+        # List of (execution, reason) tuples
+        self.failures = failures
+
+
 def wait_for_execution(client, execution, logger, tenant=None, timeout=10*60,
                        allow_client_error=False):
     logger.info(
@@ -481,6 +661,98 @@ def run_blocking_execution(client, deployment_id, workflow_id, logger,
                        tenant=tenant, timeout=timeout)
 
 
+def wait_for_executions(client, executions, logger, tenant=None,
+                        timeout=10*60, poll_interval=2):
+    """Wait for several executions at once, yielding each one as it ends.
+    Every tick, the states of all pending executions are retrieved with a
+    single list call and their events with batched events calls, instead of
+    running a polling loop per execution.
+    All executions are waited for even if some fail; an ExecutionsFailed
+    describing every failure (including timeouts) is then raised.
+    """
+    pending = {execution['id']: execution for execution in executions}
+    total = len(pending)
+    logger.info('Waiting for executions: %s', ', '.join(sorted(pending)))
+    timeout_time = datetime.now() + timedelta(seconds=timeout)
+    current_time = datetime.now()
+    with set_client_tenant(client, tenant):
+        output_executions_events(client, list(pending), logger,
+                                 to_time=current_time)
+
+    failures = []
+    # Finished executions get one more tick for any last second events
+    draining = []
+    while pending or draining:
+        time.sleep(poll_interval)
+        prev_time = current_time
+        current_time = datetime.now()
+
+        with set_client_tenant(client, tenant):
+            if pending:
+                updated = client.executions.list(
+                    id=list(pending),
+                    include_system_workflows=True,
+                    _size=len(pending),
+                )
+            else:
+                updated = []
+            output_executions_events(
+                client,
+                list(pending) + [execution.id for execution in draining],
+                logger, prev_time, current_time,
+            )
+
+        finished = draining
+        draining = []
+        for execution in updated:
+            if execution.status not in execution.END_STATES:
+                continue
+            pending.pop(execution.id)
+            draining.append(execution)
+            if execution.status == execution.TERMINATED:
+                logger.info('Execution %s (%s on %s) completed',
+                            execution.id, execution.workflow_id,
+                            execution.deployment_id)
+            else:
+                logger.warning('Execution %s (%s on %s) failed',
+                               execution.id, execution.workflow_id,
+                               execution.deployment_id)
+                failures.append((execution, '{status}: {error}'.format(
+                    status=execution.status,
+                    error=execution['error'],
+                )))
+
+        for execution in updated:
+            if execution.id in pending:
+                pending[execution.id] = execution
+        if pending and current_time >= timeout_time:
+            for execution in pending.values():
+                failures.append((
+                    execution,
+                    'timed out in state {}'.format(execution['status']),
+                ))
+            pending = {}
+
+        for execution in finished:
+            yield execution
+
+    if failures:
+        raise ExecutionsFailed(
+            '{failed} of {total} executions failed: {errors}'.format(
+                failed=len(failures),
+                total=total,
+                errors='; '.join(
+                    '{} ({} on {}): {}'.format(
+                        execution['id'], execution['workflow_id'],
+                        execution['deployment_id'], reason,
+                    )
+                    for execution, reason in failures
+                ),
+            ),
+            failures,
+        )
+
+
 def output_events(client, execution, logger, from_time=None, to_time=None):
     if from_time:
         from_time = from_time.strftime('%Y-%m-%d %H:%M:%S')
@@ -494,6 +766,36 @@ def output_events(client, execution, logger, from_time=None, to_time=None):
         from_datetime=from_time,
         to_datetime=to_time,
     )
+    _log_events(events, logger)
+
+
+def output_executions_events(client, execution_ids, logger, from_time=None,
+                             to_time=None, page_size=1000):
+    """Log the events of several executions, retrieved in batches."""
+    if not execution_ids:
+        return
+    if from_time:
+        from_time = from_time.strftime('%Y-%m-%d %H:%M:%S')
+    if to_time:
+        to_time = to_time.strftime('%Y-%m-%d %H:%M:%S')
+    offset = 0
+    while True:
+        events = client.events.list(
+            execution_id=execution_ids,
+            _size=page_size,
+            _offset=offset,
+            include_logs=True,
+            sort='reported_timestamp',
+            from_datetime=from_time,
+            to_datetime=to_time,
+        )
+        _log_events(events, logger, show_deployment=True)
+        offset += len(events)
+        if len(events) < page_size:
+            break
+
+
+def _log_events(events, logger, show_deployment=False):
     log_methods = {
         'debug': logger.debug,
         'info': logger.info,
@@ -516,9 +818,16 @@ def output_events(client, execution, logger, from_time=None, to_time=None):
             if message.strip().endswith('nothing to do'):
                 # All well and good, but let's not bloat the logs
                 continue
+            source = node_instance
+            if show_deployment:
+                source = '/'.join(
+                    part for part in [event.get('deployment_id'),
+                                      node_instance]
+                    if part
+                )
             log_methods[level](
                 '%s%s',
-                '({}) '.format(node_instance) if node_instance else '',
+                '({}) '.format(source) if source else '',
                 message,
             )
 
@@ -590,28 +899,51 @@ class DeploymentDeletionError(Exception):
 
 
 def delete_deployment(client, deployment_id, logger):
-    logger.info('Deleting deployment %s', deployment_id)
-    client.deployments.delete(deployment_id)
+    delete_deployments(client, [deployment_id], logger)
+
+
+def delete_deployments(client, deployment_ids, logger, max_workers=10):
+    """Delete several deployments at once, waiting for them all to go.
+    Deletions are requested concurrently and then tracked with one list call
+    per tick.
+    """
+    deployment_ids = list(deployment_ids)
+    if not deployment_ids:
+        return
+
+    def _delete(deployment_id):
+        logger.info('Deleting deployment %s', deployment_id)
+        client.deployments.delete(deployment_id)
+
+    try:
+        run_in_parallel(_delete, deployment_ids, max_workers=max_workers,
+                        logger=logger)
+    except ParallelExecutionError as err:
+        if len(deployment_ids) == 1:
+            # Callers deleting one deployment expect the client's error
+            raise err.failures[0][1]
+        raise
     # Allow a short delay to allow some time for the deletion
     time.sleep(0.5)
 
+    remaining = set(deployment_ids)
     for _ in range(40):
-        found = False
-        deployments = client.deployments.list()
-        for deployment in deployments:
-            if deployment['id'] == deployment_id:
-                found = True
-                logger.info('Still waiting for deployment %s to delete',
-                            deployment_id)
-                time.sleep(2)
-                break
-
-    if found:
-        raise DeploymentDeletionError(
-            'Deployment {} did not finish deleting.'.format(
-                deployment_id,
+        remaining = {
+            deployment['id'] for deployment in client.deployments.list(
+                id=list(remaining), _include=['id'], _size=len(remaining),
             )
+        }
+        if not remaining:
+            return
+        logger.info('Still waiting for deployments to delete: %s',
+                    ', '.join(sorted(remaining)))
+        time.sleep(2)
+
+    raise DeploymentDeletionError(
+        'Deployments did not finish deleting: {}'.format(
+            ', '.join(sorted(remaining)),
         )
+    )
 
 
 @retrying.retry(stop_max_attempt_number=100, wait_fixed=250)
@@ -635,20 +967,111 @@ def cancel_install(example, deployment_id):
     example.manager.client.executions.cancel(exec_list[0].id)
 
 
-def get_node_instances(node_name, deployment_id, client):
-    node_instances = []
-
-    node_instance_list = client.node_instances.list(
+def _get_latest_execution(client, deployment_id):
+    executions = client.executions.list(
         deployment_id=deployment_id,
+        include_system_workflows=True,
+        sort='created_at',
+        is_descending=True,
+        _include=['id', 'status'],
+        _size=1,
+    )
+    return executions[0] if executions else None
+
+
+def get_node_instance_index(client, deployment_id):
+    """Get all node instances of a deployment, with their runtime properties,
+    as a dict of node ID: [node instances].
+    The index is memoized until another workflow runs on the deployment, so
+    repeated lookups only cost a check of its latest execution. Changes made
+    to node instances outside of workflows are not noticed.
+    Each call returns its own copy, so callers may change what they get.
+    """
+    tenant = client._client.headers.get(CLOUDIFY_TENANT_HEADER)
+    latest = _get_latest_execution(client, deployment_id)
+    marker = (latest['id'], latest['status']) if latest else None
+
+    with _node_instance_indexes_lock:
+        deployment_indexes = _node_instance_indexes.setdefault(client, {})
+        cached_marker, index = deployment_indexes.get(
+            (tenant, deployment_id), (None, None))
+    if index is not None and marker == cached_marker:
+        return copy.deepcopy(index)
+
+    index = {}
+    for node_instance in client.node_instances.list(
+            deployment_id=deployment_id, _get_all_results=True):
+        index.setdefault(node_instance['node_id'], []).append(node_instance)
+
+    # Runtime properties may still change while a workflow is running
+    if latest and latest['status'] in latest.END_STATES:
+        with _node_instance_indexes_lock:
+            deployment_indexes[(tenant, deployment_id)] = (marker, index)
+        return copy.deepcopy(index)
+    return index
+
+
+def get_node_instances(node_name, deployment_id, client):
+    return list(
+        get_node_instance_index(client, deployment_id).get(node_name, [])
     )
 
-    for inst in node_instance_list:
-        if inst['node_id'] == node_name:
-            node_instances.append(client.node_instances.get(
-                inst['id'],
-            ))
 
-    return node_instances
+class ParallelExecutionError(Exception):
+    """One or more calls made by run_in_parallel failed."""
+    def __init__(self, message, failures):
+        self.failures = failures
+        super(ParallelExecutionError, self).__init__(message)
+
+
+def run_in_parallel(func, items, max_workers=None, logger=logging):
+    """Call func once for each item, using a pool of worker threads.
+    Returns the results in the same order as the items.
+    All calls are allowed to finish, after which a ParallelExecutionError
+    will be raised if any of them failed. Its failures attribute is a list
+    of (item, exception) tuples.
+    """
+    items = list(items)
+    if not items:
+        return []
+    max_workers = max_workers or len(items)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(func, item) for item in items]
+
+    outcomes = []
+    for future in futures:
+        err = future.exception()
+        outcomes.append((None if err else future.result(), err))
+    return collect_parallel_results(items, outcomes, logger)
+
+
+def collect_parallel_results(items, outcomes, logger=logging):
+    """Turn (result, exception) outcomes of parallel calls on items into a
+    list of results, raising a ParallelExecutionError if any failed.
+    """
+    results = []
+    failures = []
+    for item, (result, err) in zip(items, outcomes):
+        if err is None:
+            results.append(result)
+        else:
+            logger.error('Failed for %s: %s', item, err)
+            failures.append((item, err))
+            results.append(None)
+
+    if failures:
+        raise ParallelExecutionError(
+            '{failed} of {total} parallel calls failed: {errors}'.format(
+                failed=len(failures),
+                total=len(items),
+                errors='; '.join(
+                    '{}: {}'.format(item, err) for item, err in failures
+                ),
+            ),
+            failures,
+        )
+    return results
 
 
 def update_dictionary(dict1, dict2):
@@ -720,6 +1143,47 @@ def wait_for_blueprint_upload(client, blueprint_id):
                            .format(blueprint_id))
 
 
+def upload_blueprint_by_hash(client, path, name, logger):
+    """Upload a blueprint with global visibility, using an ID derived from
+    its content so that it is only uploaded once and can then be used from
+    any tenant. Returns the blueprint ID.
+    The blueprint is owned by the default tenant, so that it outlives the
+    (test) tenant the client is using.
+    """
+    with set_client_tenant(client, 'default_tenant'):
+        return _upload_blueprint_by_hash(client, path, name, logger)
+
+
+def _upload_blueprint_by_hash(client, path, name, logger):
+    blueprint_id = '{}-{}'.format(name, get_file_sha256(path)[:16])
+    try:
+        blueprint = client.blueprints.get(blueprint_id)
+    except CloudifyClientError as err:
+        if err.status_code != 404:
+            raise
+        blueprint = None
+
+    state = (blueprint or {}).get('state', '')
+    if state.startswith('failed') or state == 'invalid':
+        logger.info('Removing failed upload of blueprint %s', blueprint_id)
+        client.blueprints.delete(blueprint_id)
+        blueprint = None
+
+    if blueprint is None:
+        logger.info('Uploading blueprint %s', blueprint_id)
+        try:
+            client.blueprints.upload(path, blueprint_id,
+                                     visibility='global', async_upload=True)
+        except CloudifyClientError as err:
+            # Conflicts mean it is already being uploaded by someone else
+            if err.status_code != 409:
+                raise
+    else:
+        logger.info('Using existing blueprint %s', blueprint_id)
+    wait_for_blueprint_upload(client, blueprint_id)
+    return blueprint_id
+
+
 def substitute_testing_version(original_string, testing_version):
     return original_string.format(
         testing_version=testing_version,
@@ -0,0 +1,242 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import tempfile
+import threading
+import time
+
+from path import Path
+
+from cosmo_tester.framework import test_hosts, util
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_vm_pool(test_config, logger):
+    """Get the warm VM pool for this test session, creating it on first use.
+    Returns None if the pool is not enabled in the config.
+    """
+    global _pool
+    if not test_config['vm_pool']['enabled']:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = VMPool(test_config, logger)
+        return _pool
+
+
+def close_vm_pool():
+    """Tear down the warm VM pool, if one was created."""
+    global _pool
+    with _pool_lock:
+        pool = _pool
+        _pool = None
+    if pool is not None:
+        pool.close()
+
+
+class Lease(object):
+    def __init__(self, pool, key, vm, created_at):
+        self._pool = pool
+        self.key = key
+        self.vm = vm
+        self.created_at = created_at
+
+    @property
+    def age(self):
+        return time.time() - self.created_at
+
+    def release(self):
+        """Give the VM back to the pool, which destroys it."""
+        self._pool.release(self)
+
+
+class VMPool(object):
+    """Keeps pre-provisioned test VMs ready to be leased by Hosts.create.
+
+    Idle VMs are kept per (image type, flavor) in a tenant and
+    infrastructure deployment of the pool's own, and are reachable with the
+    pool's own SSH key. Leasing a VM authorizes the lessee's key on it.
+    A VM is only ever leased once: tests may leave anything behind on it
+    (agents, hosts file entries, hostname, packages), so releasing it
+    destroys it. The pool is refilled with fresh VMs to its configured size
+    in the background whenever VMs of a kind are asked for.
+    """
+
+    def __init__(self, test_config, logger):
+        config = test_config['vm_pool']
+        self.size = config['size']
+        self.max_age = config['max_age']
+        self._test_config = test_config
+        self._logger = logger
+        self._tmpdir = Path(tempfile.mkdtemp(prefix='vm_pool_'))
+        # Used to reach pooled VMs while they are not leased
+        self._ssh_key = util.GeneratedSSHKey(self._tmpdir, 'vm_pool_key')
+        self._hosts = test_hosts.Hosts(self._ssh_key, self._tmpdir,
+                                       test_config, logger, request=None,
+                                       instances=[])
+        self._identifier = 'vmpool_{}'.format(
+            datetime.strftime(datetime.now(), '%Y%m%d%H%M%S'))
+        self._infrastructure_ready = False
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._provisioning = {}
+        self._leased = set()
+        self._closed = False
+        self._pending = set()
+        # Only one worker, as the pool's Hosts is not safe to use from
+        # several threads at once
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def can_provide(instance):
+        # Managers get bootstrapped and Windows VMs and VMs with custom
+        # userdata are configured on creation, so they can't be shared
+        return not (instance.is_manager or instance.windows
+                    or instance.userdata)
+
+    def lease(self, image_type, flavor, ssh_key):
+        """Lease an idle VM, authorizing ssh_key on it.
+        Returns a Lease, or None if no VM was ready.
+        """
+        key = (image_type, flavor)
+        lease = None
+        expired = []
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            while idle and lease is None:
+                candidate = idle.pop(0)
+                if candidate.age > self.max_age:
+                    expired.append(candidate)
+                else:
+                    lease = candidate
+                    self._leased.add(lease)
+            if lease:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        for old_lease in expired:
+            self._submit(self._destroy, old_lease)
+        self._schedule_refill(key)
+
+        if lease is None:
+            self._logger.info('No pooled VM ready for %s (%s).',
+                              image_type, flavor)
+            return None
+
+        try:
+            with open(ssh_key.public_key_path) as key_handle:
+                public_key = key_handle.read().strip()
+            lease.vm.run_command(
+                "echo '{}' >> ~/.ssh/authorized_keys".format(public_key),
+                hide_stdout=True,
+            )
+        except Exception as err:
+            self._logger.warning('Could not lease pooled VM %s: %s',
+                                 lease.vm.ip_address, err)
+            with self._lock:
+                self._leased.discard(lease)
+            self._submit(self._destroy, lease)
+            return None
+
+        self._logger.info('Leased pooled VM %s for %s (%s).',
+                          lease.vm.ip_address, image_type, flavor)
+        return lease
+
+    def release(self, lease):
+        with self._lock:
+            self._leased.discard(lease)
+        self._submit(self._destroy, lease)
+
+    def _submit(self, func, *args):
+        """Run func in the background, unless the pool is closed.
+        Returns whether it was submitted.
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            future = self._executor.submit(func, *args)
+            self._pending.add(future)
+        future.add_done_callback(self._forget)
+        return True
+
+    def _forget(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def _schedule_refill(self, key):
+        with self._lock:
+            if self._closed:
+                return
+            wanted = (self.size - len(self._idle.get(key, []))
+                      - self._provisioning.get(key, 0))
+            if wanted <= 0:
+                return
+            self._provisioning[key] = self._provisioning.get(key, 0) + wanted
+        if not self._submit(self._provision, key, wanted):
+            with self._lock:
+                self._provisioning[key] -= wanted
+
+    def _provision(self, key, count):
+        image_type, flavor = key
+        try:
+            if not self._infrastructure_ready:
+                self._hosts._create_test_infrastructure(self._identifier)
+                self._infrastructure_ready = True
+
+            self._logger.info('Provisioning %d pooled VM(s) for %s (%s).',
+                              count, image_type, flavor)
+            vms = [test_hosts.VM(image_type, self._test_config)
+                   for _ in range(count)]
+            self._hosts.server_flavor = flavor
+            first_index = len(self._hosts.instances)
+            self._hosts.instances.extend(vms)
+            self._hosts._deploy_instances(
+                list(range(first_index, first_index + count)))
+            self._hosts.wait_for_ssh(instances=vms)
+            now = time.time()
+            with self._lock:
+                self._idle.setdefault(key, []).extend(
+                    Lease(self, key, vm, now) for vm in vms)
+        except Exception as err:
+            self._logger.error('Failed to provision pooled VMs for %s (%s): '
+                               '%s', image_type, flavor, err)
+        finally:
+            with self._lock:
+                self._provisioning[key] -= count
+
+    def _destroy(self, lease):
+        lease.vm.close_ssh_connections()
+        try:
+            self._hosts._undeploy_test_vm(lease.vm.deployment_id)
+        except Exception as err:
+            # It will be cleaned up with the rest of the pool
+            self._logger.warning('Could not destroy pooled VM %s: %s',
+                                 lease.vm.ip_address, err)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            outstanding = len(self._leased)
+            pending = list(self._pending)
+        # Anything not started yet would only be torn down again with the
+        # rest of the pool, so only wait for what is already running
+        for future in pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+        self._logger.info('VM pool: %d hits, %d misses.',
+                          self.hits, self.misses)
+        for lease in sum(self._idle.values(), []):
+            lease.vm.close_ssh_connections()
+        if outstanding:
+            self._logger.warning(
+                '%d pooled VMs are still leased, not tearing down the pool. '
+                'To tear down, clean deployments on your test manager under '
+                'tenant %s', outstanding, self._identifier,
+            )
+            return
+        self._hosts.destroy(passed=True)
@@ -0,0 +1,237 @@
+from base64 import b64decode, b64encode
+import hashlib
+import threading
+
+import requests
+import winrm
+from winrm.exceptions import WinRMError, WinRMTransportError
+
+# Each chunk is sent base64 encoded in a powershell -EncodedCommand, run
+# without cmd.exe so that it only has to fit within the 32k command line
+# limit of CreateProcess.
+DEFAULT_UPLOAD_CHUNK_SIZE = 6144
+# Downloaded chunks come back as command output, which has no such limit
+DEFAULT_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+SHA256_SCRIPT = '''
+$sha = [System.Security.Cryptography.SHA256]::Create()
+$stream = [System.IO.File]::OpenRead('{path}')
+try {{
+    $hash = $sha.ComputeHash($stream)
+}} finally {{
+    $stream.Close()
+}}
+[System.BitConverter]::ToString($hash).Replace('-', '').ToLower()
+'''
+
+WRITE_CHUNK_SCRIPT = '''
+$bytes = [System.Convert]::FromBase64String('{data}')
+$stream = [System.IO.File]::Open('{path}', [System.IO.FileMode]::{mode})
+try {{
+    $stream.Write($bytes, 0, $bytes.Length)
+}} finally {{
+    $stream.Close()
+}}
+'''
+
+READ_CHUNK_SCRIPT = '''
+$stream = [System.IO.File]::OpenRead('{path}')
+try {{
+    $stream.Seek({offset}, [System.IO.SeekOrigin]::Begin) | Out-Null
+    $bytes = New-Object byte[] {length}
+    $read = $stream.Read($bytes, 0, {length})
+}} finally {{
+    $stream.Close()
+}}
+[System.Convert]::ToBase64String($bytes, 0, $read)
+'''
+
+FINISH_UPLOAD_SCRIPT = '''
+$target = '{path}'
+$parent = Split-Path -Parent $target
+if ($parent -and -not (Test-Path -LiteralPath $parent)) {{
+    New-Item -ItemType Directory -Path $parent | Out-Null
+}}
+Move-Item -LiteralPath '{part_path}' -Destination $target -Force
+'''
+
+
+class WinRMTransferError(Exception):
+    """A file transfer to or from a Windows VM failed."""
+
+
+def _ps_quote(value):
+    # Single quoted powershell strings only need single quotes doubled
+    return str(value).replace("'", "''")
+
+
+class WinRMShellSession(object):
+    """A WinRM session which keeps one remote shell open for all commands.
+
+    pywinrm's Session creates and deletes a shell for every command; this
+    offers the same run_cmd and run_ps calls (returning winrm.Response) but
+    only opens a new shell when there isn't one, or the old one has expired
+    (e.g. because of its idle timeout or a reboot of the VM).
+    Commands are serialised, as a shell runs one command at a time.
+    """
+
+    def __init__(self, host, username, password, logger, port=5985):
+        self._session = winrm.Session(
+            'http://{host}:{port}/wsman'.format(host=host, port=port),
+            auth=(username, password),
+        )
+        self._logger = logger
+        self._shell_id = None
+        self._lock = threading.Lock()
+        self.shells_opened = 0
+
+    @property
+    def _protocol(self):
+        return self._session.protocol
+
+    def _start_command(self, command, args, skip_cmd_shell=False):
+        if self._shell_id is None:
+            self._shell_id = self._protocol.open_shell()
+            self.shells_opened += 1
+        return self._protocol.run_command(self._shell_id, command, args,
+                                          skip_cmd_shell=skip_cmd_shell)
+
+    def run_cmd(self, command, args=(), skip_cmd_shell=False):
+        with self._lock:
+            reusing_shell = self._shell_id is not None
+            try:
+                command_id = self._start_command(command, args,
+                                                 skip_cmd_shell)
+            except (WinRMError, WinRMTransportError,
+                    requests.exceptions.ConnectionError) as err:
+                if not reusing_shell:
+                    self._discard_shell()
+                    raise
+                # The command can't have started, so it's safe to retry it
+                # once in a new shell
+                self._logger.info('WinRM shell is gone (%s), opening a new '
+                                  'one.', err)
+                self._shell_id = None
+                command_id = self._start_command(command, args,
+                                                 skip_cmd_shell)
+
+            try:
+                result = winrm.Response(self._protocol.get_command_output(
+                    self._shell_id, command_id))
+                self._protocol.cleanup_command(self._shell_id, command_id)
+            except Exception:
+                # Don't trust this shell for any further commands
+                self._discard_shell()
+                raise
+            return result
+
+    def run_ps(self, script, skip_cmd_shell=False):
+        # Encoded the same way as pywinrm's Session.run_ps
+        encoded_ps = b64encode(script.encode('utf_16_le')).decode('ascii')
+        result = self.run_cmd(
+            'powershell -encodedcommand {0}'.format(encoded_ps),
+            skip_cmd_shell=skip_cmd_shell)
+        if len(result.std_err):
+            result.std_err = self._session._clean_error_msg(result.std_err)
+        return result
+
+    def _run_transfer_step(self, script, description):
+        result = self.run_ps(script, skip_cmd_shell=True)
+        if result.status_code != 0:
+            raise WinRMTransferError('Failed to {desc}: {err}'.format(
+                desc=description,
+                err=result.std_err.decode('utf-8', 'replace').strip(),
+            ))
+        return result.std_out.decode('ascii', 'replace').strip()
+
+    def get_sha256(self, remote_path):
+        return self._run_transfer_step(
+            SHA256_SCRIPT.format(path=_ps_quote(remote_path)),
+            'hash {}'.format(remote_path),
+        )
+
+    def put_file(self, remote_path, source,
+                 chunk_size=DEFAULT_UPLOAD_CHUNK_SIZE):
+        """Upload the content of a binary file-like object, replacing the
+        remote file. The data is written to a temporary file and only moved
+        into place once its sha256 digest has been verified.
+        Returns the number of bytes uploaded.
+        """
+        part_path = '{}.part'.format(remote_path)
+        digest = hashlib.sha256()
+        size = 0
+        mode = 'Create'
+        while True:
+            chunk = source.read(chunk_size)
+            # Always write at least once so that empty files are created
+            if not chunk and mode == 'Append':
+                break
+            digest.update(chunk)
+            size += len(chunk)
+            self._run_transfer_step(
+                WRITE_CHUNK_SCRIPT.format(
+                    data=b64encode(chunk).decode('ascii'),
+                    path=_ps_quote(part_path),
+                    mode=mode,
+                ),
+                'write to {}'.format(part_path),
+            )
+            mode = 'Append'
+
+        remote_digest = self.get_sha256(part_path)
+        if remote_digest != digest.hexdigest():
+            raise WinRMTransferError(
+                'Checksum mismatch uploading {path}: expected {local}, '
+                'got {remote}'.format(path=remote_path,
+                                      local=digest.hexdigest(),
+                                      remote=remote_digest)
+            )
+        self._run_transfer_step(
+            FINISH_UPLOAD_SCRIPT.format(path=_ps_quote(remote_path),
+                                        part_path=_ps_quote(part_path)),
+            'move {} into place'.format(remote_path),
+        )
+        return size
+
+    def get_file(self, remote_path, destination,
+                 chunk_size=DEFAULT_DOWNLOAD_CHUNK_SIZE):
+        """Download a remote file into a binary file-like object, verifying
+        its sha256 digest. Returns the number of bytes downloaded.
+        """
+        digest = hashlib.sha256()
+        offset = 0
+        while True:
+            chunk = b64decode(self._run_transfer_step(
+                READ_CHUNK_SCRIPT.format(path=_ps_quote(remote_path),
+                                         offset=offset,
+                                         length=chunk_size),
+                'read {}'.format(remote_path),
+            ))
+            destination.write(chunk)
+            digest.update(chunk)
+            offset += len(chunk)
+            if len(chunk) < chunk_size:
+                break
+
+        remote_digest = self.get_sha256(remote_path)
+        if remote_digest != digest.hexdigest():
+            raise WinRMTransferError(
+                'Checksum mismatch downloading {path}: expected {remote}, '
+                'got {local}'.format(path=remote_path,
+                                     local=digest.hexdigest(),
+                                     remote=remote_digest)
+            )
+        return offset
+
+    def _discard_shell(self):
+        shell_id = self._shell_id
+        self._shell_id = None
+        if shell_id is not None:
+            try:
+                self._protocol.close_shell(shell_id)
+            except Exception:
+                pass
+
+    def close(self):
+        with self._lock:
+            self._discard_shell()
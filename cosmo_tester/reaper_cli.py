@@ -0,0 +1,199 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import sys
+import time
+
+from cosmo_tester.framework.config import load_config
+from cosmo_tester.framework.logger import get_logger
+
+
+def _format_age(seconds):
+    hours, remainder = divmod(int(seconds), 3600)
+    return '{}h{:02d}m'.format(hours, remainder // 60)
+
+
+def describe_tenant(client, tenant):
+    """Get the deployments in a test tenant, and the IPs of its test VMs."""
+    from cosmo_tester.framework import util
+
+    with util.set_client_tenant(client, tenant):
+        deployments = sorted(
+            deployment['id']
+            for deployment in client.deployments.list(_include=['id'])
+        )
+        vms = {
+            node_instance['deployment_id']: node_instance[
+                'runtime_properties'].get('public_ip_address')
+            for node_instance in client.node_instances.list(
+                node_id='test_host',
+                _include=['deployment_id', 'runtime_properties'],
+            )
+        }
+    return deployments, vms
+
+
+def list_tenants(client, tenants, logger):
+    if not tenants:
+        print('No test tenants found.')
+        return
+    for tenant, age in tenants:
+        try:
+            deployments, vms = describe_tenant(client, tenant)
+        except Exception as err:
+            logger.warning('Could not inspect %s: %s', tenant, err)
+            continue
+        print('{tenant} (age {age}): {count} deployment(s)'.format(
+            tenant=tenant, age=_format_age(age), count=len(deployments),
+        ))
+        for deployment in deployments:
+            if deployment in vms:
+                print('    {} (VM: {})'.format(
+                    deployment, vms[deployment] or 'no IP'))
+            else:
+                print('    {}'.format(deployment))
+
+
+def teardown_tenants(infra_mgr_config, tenants, workers, logger):
+    """Tear down tenants concurrently, reporting progress as each finishes.
+    Returns the names of the tenants which could not be torn down.
+    """
+    from cosmo_tester.framework.teardown import (
+        create_infrastructure_manager_client,
+        teardown_tenant,
+    )
+
+    def _teardown(tenant):
+        start = time.time()
+        # Clients are not shared, as each switches to its own tenant
+        teardown_tenant(create_infrastructure_manager_client(
+            infra_mgr_config), tenant, get_logger(tenant))
+        return time.time() - start
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_teardown, tenant): tenant
+                   for tenant in tenants}
+        for done, future in enumerate(as_completed(futures), 1):
+            tenant = futures[future]
+            try:
+                duration = future.result()
+            except Exception as err:
+                failed.append(tenant)
+                logger.error('[%d/%d] Failed to tear down %s: %s',
+                             done, len(tenants), tenant, err)
+            else:
+                logger.info('[%d/%d] Tore down %s in %.1fs',
+                            done, len(tenants), tenant, duration)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            'Tool for finding and removing test resources left on the '
+            'infrastructure manager.'
+        ),
+    )
+    parser.add_argument(
+        '-c', '--config-location',
+        help='The test config file.',
+        default='test_config.yaml',
+    )
+
+    subparsers = parser.add_subparsers(help='Action',
+                                       dest='action')
+
+    list_args = subparsers.add_parser(
+        'list', help='List test tenants with their deployments and VMs.')
+    teardown_args = subparsers.add_parser(
+        'teardown', help='Tear down test tenants.')
+    for args in list_args, teardown_args:
+        args.add_argument(
+            '-o', '--older-than',
+            help='Only include tenants older than this many hours.',
+            type=float,
+            default=0,
+        )
+        args.add_argument(
+            '--include-shared',
+            help=(
+                'Also include the VM pool and shared infrastructure tenants, '
+                'which may be in use by running test sessions.'
+            ),
+            action='store_true',
+        )
+    teardown_args.add_argument(
+        'tenants',
+        help=(
+            'The tenants to tear down. If none are given, either --all or '
+            'a positive --older-than must be.'
+        ),
+        nargs='*',
+    )
+    teardown_args.add_argument(
+        '--all',
+        help=(
+            'Tear down all test tenants matching --older-than, including '
+            'those of test runs which may still be in progress.'
+        ),
+        action='store_true',
+    )
+    teardown_args.add_argument(
+        '-w', '--workers',
+        help='How many tenants to tear down at once.',
+        type=int,
+        default=4,
+    )
+
+    args = parser.parse_args()
+    if not args.action:
+        parser.print_help()
+        sys.exit(2)
+    if (args.action == 'teardown' and not args.tenants and not args.all
+            and args.older_than <= 0):
+        parser.error('Give the tenants to tear down, --all, or a positive '
+                     '--older-than.')
+
+    logger = get_logger('reaper_cli')
+    config = load_config(logger, args.config_location)
+    infra_mgr_config = config['infrastructure_manager']
+
+    # Imported here to keep the tool quick to start for --help
+    from cosmo_tester.framework.teardown import (
+        create_infrastructure_manager_client,
+        find_test_tenants,
+    )
+    client = create_infrastructure_manager_client(infra_mgr_config)
+    # Tenants named explicitly may be shared ones
+    tenants = find_test_tenants(
+        client, min_age=args.older_than * 3600,
+        include_shared=args.include_shared or bool(
+            getattr(args, 'tenants', None)),
+    )
+
+    if args.action == 'list':
+        list_tenants(client, tenants, logger)
+    elif args.action == 'teardown':
+        if args.tenants:
+            known = dict(tenants)
+            unknown = [tenant for tenant in args.tenants
+                       if tenant not in known]
+            if unknown:
+                logger.error('Not test tenants matching the given age: %s',
+                             ', '.join(unknown))
+                sys.exit(2)
+            selected = args.tenants
+        else:
+            selected = [tenant for tenant, _ in tenants]
+        if not selected:
+            logger.info('No test tenants to tear down.')
+            return
+        logger.info('Tearing down %d tenant(s) with %d workers: %s',
+                    len(selected), args.workers, ', '.join(selected))
+        if teardown_tenants(infra_mgr_config, selected, args.workers,
+                            logger):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
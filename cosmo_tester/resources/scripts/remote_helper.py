@@ -0,0 +1,198 @@
+"""Long lived helper for running commands and file operations on test VMs.
+
+This is started once (as root) over SSH and reads one JSON request per line
+from stdin, writing one JSON response per line to stdout.
+Commands are run as the given user through their login shell, with sudo
+prefixed for sudo commands, the same way fabric would run them.
+It must run under both python 2 and python 3.
+
+Usage: remote_helper.py <user to run commands as>
+"""
+import base64
+import grp
+import hashlib
+import json
+import os
+import pwd
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+
+# The exit code given to commands which time out, as coreutils timeout does
+TIMEOUT_EXIT_CODE = 124
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _b64decode(data):
+    return base64.b64decode(data.encode('ascii'))
+
+
+class Helper(object):
+    def __init__(self, user):
+        self.user = pwd.getpwnam(user)
+        self.groups = [self.user.pw_gid] + [
+            group.gr_gid for group in grp.getgrall()
+            if user in group.gr_mem
+        ]
+        self.umask = os.umask(0)
+        os.umask(self.umask)
+
+    def _prepare_child(self):
+        # In its own process group, so that everything it starts can be
+        # killed if it times out
+        os.setsid()
+        os.setgroups(self.groups)
+        os.setgid(self.user.pw_gid)
+        os.setuid(self.user.pw_uid)
+
+    def op_exec(self, command, sudo=False, timeout=None):
+        if sudo:
+            # Like fabric, only the first command of a chain is run with sudo
+            command = 'sudo -n ' + command
+        env = dict(os.environ)
+        env.update({
+            'HOME': self.user.pw_dir,
+            'USER': self.user.pw_name,
+            'LOGNAME': self.user.pw_name,
+            'SHELL': self.user.pw_shell or '/bin/sh',
+        })
+        cwd = self.user.pw_dir if os.path.isdir(self.user.pw_dir) else '/'
+        with open(os.devnull, 'rb') as devnull:
+            proc = subprocess.Popen(
+                [self.user.pw_shell or '/bin/sh', '-c', command],
+                stdin=devnull,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                preexec_fn=self._prepare_child,
+                env=env,
+                cwd=cwd,
+            )
+            timed_out = []
+            timer = None
+            if timeout:
+                timer = threading.Timer(
+                    timeout, self._kill, (proc, timed_out))
+                timer.start()
+            try:
+                stdout, stderr = proc.communicate()
+            finally:
+                if timer:
+                    timer.cancel()
+        return_code = proc.returncode
+        if timed_out:
+            return_code = TIMEOUT_EXIT_CODE
+            stderr += 'Command timed out after {0} seconds.\n'.format(
+                timeout).encode('utf-8')
+        return {
+            'return_code': return_code,
+            'stdout': _b64encode(stdout),
+            'stderr': _b64encode(stderr),
+        }
+
+    @staticmethod
+    def _kill(proc, timed_out):
+        timed_out.append(True)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def op_read(self, path, offset=0, length=None):
+        with open(path, 'rb') as fh:
+            fh.seek(offset)
+            if length is None:
+                data = fh.read()
+            else:
+                data = fh.read(length)
+        return {'data': _b64encode(data)}
+
+    def op_write(self, path, data, owner=None, mode=None):
+        directory = os.path.dirname(path) or '.'
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(_b64decode(data))
+            # Without an owner or mode, files end up as they would when
+            # uploaded over SSH: the user's, with default permissions
+            if owner:
+                subprocess.check_call(['chown', owner, tmp_path])
+            else:
+                os.chown(tmp_path, self.user.pw_uid, self.user.pw_gid)
+            if mode:
+                os.chmod(tmp_path, int(mode, 8))
+            else:
+                os.chmod(tmp_path, 0o666 & ~self.umask)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return {}
+
+    def op_stat(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return {'exists': False}
+        return {
+            'exists': True,
+            'is_dir': os.path.isdir(path),
+            'size': stat.st_size,
+            'mode': '{0:o}'.format(stat.st_mode & 0o7777),
+            'uid': stat.st_uid,
+            'gid': stat.st_gid,
+            'mtime': stat.st_mtime,
+        }
+
+    def op_hash(self, paths):
+        digests = {}
+        for path in paths:
+            digest = hashlib.sha256()
+            try:
+                with open(path, 'rb') as fh:
+                    for chunk in iter(lambda: fh.read(65536), b''):
+                        digest.update(chunk)
+            except (IOError, OSError):
+                continue
+            digests[path] = digest.hexdigest()
+        return {'digests': digests}
+
+    def handle(self, request):
+        op = getattr(self, 'op_' + request.pop('op'), None)
+        if op is None:
+            raise ValueError('Unknown operation')
+        return op(**request)
+
+    def serve(self):
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                break
+            try:
+                response = self.handle(json.loads(line))
+                response['ok'] = True
+            except Exception as err:
+                response = {
+                    'ok': False,
+                    'error': '{0}: {1}'.format(type(err).__name__, err),
+                    'traceback': traceback.format_exc(),
+                }
+            sys.stdout.write(json.dumps(response) + '\n')
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    # This was started from a private directory made just for it, which is
+    # not needed once it is running
+    shutil.rmtree(os.path.dirname(os.path.abspath(__file__)),
+                  ignore_errors=True)
+    Helper(sys.argv[1]).serve()
@@ -91,23 +91,21 @@ def test_slapd_ldaps_with_cluster(three_node_cluster_with_extra_node, logger):
 
 
 def _install_openldap(host, logger):
-    logger.info('Installing packages for openldap')
-    host.run_command(
+    logger.info('Installing packages and starting openldap service')
+    host.run_commands([
         'yum install -y openldap compat-openldap openldap-clients '
         'openldap-servers gnutls gnutls-utils',
-        use_sudo=True,
-    )
-    logger.info('Starting openldap service')
-    host.run_command('service slapd start', use_sudo=True)
+        'service slapd start',
+    ], use_sudo=True)
 
 
 def _generate_and_retrieve_openldap_certs(host, logger):
     logger.info('Preparing LDAP CA private key')
-    host.run_command('mkdir /etc/ssl/private', use_sudo=True)
-    host.run_command(
+    host.run_commands([
+        'sudo mkdir /etc/ssl/private',
         'certtool --generate-privkey '
-        '| sudo tee /etc/ssl/private/ldapcakey.pem >/dev/null'
-    )
+        '| sudo tee /etc/ssl/private/ldapcakey.pem >/dev/null',
+    ])
     logger.info('Generating LDAP CA public key')
     host.put_remote_file_content(
         '/tmp/ca.info',
@@ -195,27 +193,15 @@ olcAccess: {0}to * by dn.base="gidNumber=0+uidNumber=0,cn=peercred,cn=external,
         use_sudo=True,
     )
 
-    logger.info('Setting basic LDAP config')
-    host.run_command(
+    logger.info('Setting basic LDAP config and adding required schemas')
+    host.run_commands([
         'cp /usr/share/openldap-servers/DB_CONFIG.example '
         '/var/lib/ldap/DB_CONFIG',
-        use_sudo=True,
-    )
-    host.run_command(
         'chown -R ldap:ldap /var/lib/ldap/',
-        use_sudo=True,
-    )
-
-    logger.info('Adding required LDAP schemas')
-    host.run_command(
         'ldapadd -Y EXTERNAL -H ldapi:/// '
         '-f /etc/openldap/schema/cosine.ldif',
-        use_sudo=True,
-    )
-    host.run_command(
         'ldapadd -Y EXTERNAL -H ldapi:/// -f /etc/openldap/schema/nis.ldif',
-        use_sudo=True,
-    )
+    ], use_sudo=True)
 
     logger.info('Configuring ldaps')
     host.put_remote_file_content(
@@ -236,26 +222,24 @@ olcTLSCACertificateFile: /etc/ssl/certs/ldapcacert.crt''',
         use_sudo=True,
     )
     # non-tls ldap needs to be left on for the initial config
-    host.run_command(
+    host.run_commands([
         'sed -i "s#SLAPD_URLS=.*#SLAPD_URLS=\\"ldap:/// ldaps://{host_ip}/ '
         'ldapi:///\\"#" /etc/sysconfig/slapd'.format(
             host_ip=host.private_ip_address,
         ),
-        use_sudo=True,
-    )
-    host.run_command('service slapd restart', use_sudo=True)
+        'service slapd restart',
+    ], use_sudo=True)
 
 
 def _disable_slapd_non_tls(host, logger):
     logger.info('Disabling non-TLS ldap')
-    host.run_command(
+    host.run_commands([
         'sed -i "s#SLAPD_URLS=.*#SLAPD_URLS=\\"ldaps://{host_ip}/ '
         'ldapi:///\\"#" /etc/sysconfig/slapd'.format(
             host_ip=host.private_ip_address,
         ),
-        use_sudo=True,
-    )
-    host.run_command('service slapd restart', use_sudo=True)
+        'service slapd restart',
+    ], use_sudo=True)
 
 
 def _add_ous(host, logger):
@@ -56,11 +56,13 @@ def _install_cluster(node, config_dict, test_config, ssh_key, logger,
                                  yaml.dump(config_dict))
     if not override:
         node.put_remote_file(remote_path=REMOTE_SSH_KEY_PATH,
-                             local_path=ssh_key.private_key_path)
+                             local_path=ssh_key.private_key_path,
+                             check_hash=True)
 
         node.put_remote_file(remote_path=REMOTE_LICENSE_PATH,
                              local_path=util.get_resource_path(
-                                 'test_valid_paying_license.yaml'))
+                                 'test_valid_paying_license.yaml'),
+                             check_hash=True)
 
         node.run_command('yum install -y {0}'.format(
             test_config['cfy_cluster_manager']['rpm_path']), use_sudo=True)
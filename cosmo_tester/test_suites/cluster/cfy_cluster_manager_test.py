@@ -65,9 +65,7 @@ def test_three_nodes_cluster_using_provided_certificates(
     _create_certificates(local_certs_path, nodes_list)
 
     logger.info('Copying certificates to node-1')
-    for cert in local_certs_path.iterdir():
-        node1.put_remote_file(local_path=str(cert),
-                              remote_path=join(REMOTE_CERTS_PATH, cert.name))
+    node1.put_directory(local_certs_path, REMOTE_CERTS_PATH)
 
     logger.info('Preparing cluster install configuration file')
     three_nodes_config_dict = _get_config_dict(3, test_config)
@@ -1,6 +1,6 @@
 import copy
 import os
-import time
+import shutil
 
 from jinja2 import Environment, FileSystemLoader
 from os.path import join, dirname
@@ -189,16 +189,17 @@ def _get_hosts(ssh_key, module_tmpdir, test_config, logger, request,
         if has_extra_node:
             name_mappings.append('extra_node')
 
+        hosts.wait_for_ssh()
+        # This needs to happen before we start bootstrapping nodes
+        # because the hostname is used by nodes that are being
+        # bootstrapped with reference to nodes that may not have been
+        # bootstrapped yet.
         for idx, node in enumerate(hosts.instances):
-            node.wait_for_ssh()
-            # This needs to happen before we start bootstrapping nodes
-            # because the hostname is used by nodes that are being
-            # bootstrapped with reference to nodes that may not have been
-            # bootstrapped yet.
             node.hostname = name_mappings[idx]
-            node.run_command('sudo hostnamectl set-hostname {}'.format(
-                name_mappings[idx]
-            ))
+        hosts.run_on_all(
+            lambda node: 'hostnamectl set-hostname {}'.format(node.hostname),
+            use_sudo=True,
+        )
 
         if use_hostnames:
             hosts_entries = ['\n# Added for hostname test']
@@ -210,11 +211,11 @@ def _get_hosts(ssh_key, module_tmpdir, test_config, logger, request,
             hosts_entries = '\n'.join(hosts_entries)
             for node in hosts.instances:
                 node.install_config['manager']['private_ip'] = node.hostname
-                node.run_command(
-                   "echo '{hosts}' | sudo tee -a /etc/hosts".format(
-                       hosts=hosts_entries,
-                   )
+            hosts.run_on_all(
+                "echo '{hosts}' | sudo tee -a /etc/hosts".format(
+                    hosts=hosts_entries,
                 )
+            )
 
         if three_nodes_cluster:
             brokers = dbs = managers = hosts.instances[:3]
@@ -264,9 +265,8 @@ def run_cluster_bootstrap(dbs, brokers, managers, skip_bootstrap_list,
     for node in brokers + dbs:
         if node.friendly_name in skip_bootstrap_list:
             continue
-        while not node.bootstrap_is_complete():
-            logger.info('Checking state of %s', node.friendly_name)
-            time.sleep(5)
+        logger.info('Waiting for bootstrap of %s', node.friendly_name)
+        node.wait_for_bootstrap()
 
     for node_num, node in enumerate(managers, start=1):
         _bootstrap_manager_node(node, node_num, dbs, brokers,
@@ -279,16 +279,12 @@ def run_cluster_bootstrap(dbs, brokers, managers, skip_bootstrap_list,
 
 
 def _base_prep(node, tempdir):
-    with node.ssh() as fabric_ssh:
-        fabric_ssh.run(
-            'mkdir -p /tmp/bs_logs'
-        )
-
-        fabric_ssh.run(
-            'echo {name} > /tmp/bs_logs/0_node_name'.format(
-                name=node.friendly_name,
-            )
-        )
+    node.run_commands([
+        'mkdir -p /tmp/bs_logs',
+        'echo {name} > /tmp/bs_logs/0_node_name'.format(
+            name=node.friendly_name,
+        ),
+    ])
 
     ca_base = os.path.join(tempdir, 'ca.')
     ca_cert = ca_base + 'cert'
@@ -297,12 +293,13 @@ def _base_prep(node, tempdir):
     if not os.path.exists(ca_cert):
         util.generate_ca_cert(ca_cert, ca_key)
 
-    cert_base = os.path.join(tempdir, '{node_friendly_name}.{extension}')
+    # Everything this node needs is staged in one directory so that it can
+    # be sent in a single transfer
+    certs_dir = os.path.join(tempdir, node.friendly_name + '_certs')
+    util.mkdirs(certs_dir)
 
-    node_cert = cert_base.format(node_friendly_name=node.friendly_name,
-                                 extension='crt')
-    node_key = cert_base.format(node_friendly_name=node.friendly_name,
-                                extension='key')
+    node_cert = os.path.join(certs_dir, node.friendly_name + '.crt')
+    node_key = os.path.join(certs_dir, node.friendly_name + '.key')
 
     util.generate_ssl_certificate(
         [node.friendly_name, node.hostname,
@@ -314,23 +311,13 @@ def _base_prep(node, tempdir):
         ca_cert,
         ca_key,
     )
+    shutil.copy(ca_cert, os.path.join(certs_dir, 'ca.crt'))
 
     remote_cert = '/tmp/' + node.friendly_name + '.crt'
     remote_key = '/tmp/' + node.friendly_name + '.key'
     remote_ca = '/tmp/ca.crt'
 
-    node.put_remote_file(
-        local_path=node_cert,
-        remote_path=remote_cert,
-    )
-    node.put_remote_file(
-        local_path=node_key,
-        remote_path=remote_key,
-    )
-    node.put_remote_file(
-        local_path=ca_cert,
-        remote_path=remote_ca,
-    )
+    node.put_directory(certs_dir, '/tmp', exclude=['*.csr'], check_hash=True)
 
     node.local_cert = node_cert
     node.remote_cert = remote_cert
@@ -589,8 +576,8 @@ def _bootstrap_lb_node(node, managers, tempdir, logger):
     cp {ca} /etc/haproxy\n                   chown haproxy. /etc/haproxy/ca.crt
     restorecon /etc/haproxy/*""".format(
         cert=node.remote_cert, key=node.remote_key, ca=node.remote_ca)
-    node.run_command('echo "{}" > /tmp/haproxy_install.sh'.format(install_sh))
-    node.run_command('chmod 700 /tmp/haproxy_install.sh')
+    node.put_remote_file_content('/tmp/haproxy_install.sh', install_sh,
+                                 mode='700')
     node.run_command('sudo /tmp/haproxy_install.sh')
 
     # configure haproxy
@@ -598,13 +585,13 @@ def _bootstrap_lb_node(node, managers, tempdir, logger):
         loader=FileSystemLoader(CONFIG_DIR)).get_template('haproxy.cfg')
     config = template.render(managers=managers)
     config_path = '/etc/haproxy/haproxy.cfg'
-    node.put_remote_file_content(config_path, config)
-    node.run_command('sudo chown root. {}'.format(config_path))
-    node.run_command('sudo chmod 644 {}'.format(config_path))
-    node.run_command('sudo restorecon {}'.format(config_path))
-
-    node.run_command('sudo systemctl enable haproxy')
-    node.run_command('sudo systemctl restart haproxy')
+    node.put_remote_file_content(config_path, config,
+                                 owner='root:root', mode='644')
+    node.run_commands([
+        'restorecon {}'.format(config_path),
+        'systemctl enable haproxy',
+        'systemctl restart haproxy',
+    ], use_sudo=True)
 
     node.is_manager = True
     node.client = node.get_rest_client(proto='https')
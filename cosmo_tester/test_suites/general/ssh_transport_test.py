@@ -0,0 +1,40 @@
+import pytest
+
+from cosmo_tester.framework.async_ssh import benchmark_transports, run_sync
+from cosmo_tester.framework.test_hosts import Hosts, VM
+
+
+@pytest.fixture(scope='module')
+def linux_hosts(request, ssh_key, module_tmpdir, test_config, logger):
+    hosts = Hosts(ssh_key, module_tmpdir, test_config, logger, request,
+                  instances=[VM('centos_7', test_config) for _ in range(3)])
+    hosts.create()
+    try:
+        yield hosts
+    finally:
+        hosts.destroy()
+
+
+def test_asyncio_transport(linux_hosts):
+    results = linux_hosts.run_on_all(
+        lambda node: 'echo {}'.format(node.ip_address),
+        use_asyncio=True,
+    )
+    assert [result.stdout.strip() for result in results] == [
+        str(node.ip_address) for node in linux_hosts.instances
+    ]
+
+    node = linux_hosts.instances[0]
+    run_sync(node.aput_remote_file_content('/tmp/async_test', 'content',
+                                           mode='600'))
+    assert node.get_remote_file_content('/tmp/async_test') == 'content'
+    assert run_sync(
+        node.aget_remote_file_content('/tmp/async_test')) == 'content'
+
+    result = run_sync(node.arun_command('exit 3', warn_only=True))
+    assert result.return_code == 3
+
+
+def test_transport_benchmark(linux_hosts, logger):
+    durations = benchmark_transports(linux_hosts, logger)
+    assert set(durations) == {'fabric', 'asyncio'}
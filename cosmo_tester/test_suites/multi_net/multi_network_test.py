@@ -1,4 +1,3 @@
-import time
 import pytest
 from copy import deepcopy
 
@@ -66,8 +65,7 @@ def prepare_managers(managers, logger):
 
     for instance in managers:
         logger.info('Waiting for bootstrap of {}'.format(instance.server_id))
-        while not instance.bootstrap_is_complete():
-            time.sleep(3)
+        instance.wait_for_bootstrap()
 
 
 @pytest.fixture(scope='function')
@@ -23,6 +23,7 @@ setup(
     packages=['cosmo_tester'],
     license='LICENSE',
     description='Cosmo system tests framework',
+    python_requires='>=3.6',
     install_requires=[
         'fabric',
         'PyYAML',
@@ -41,6 +42,7 @@ setup(
     entry_points={
         'console_scripts': [
             'test-config = cosmo_tester.conf_cli:main',
+            'test-reaper = cosmo_tester.reaper_cli:main',
         ]
     },
 